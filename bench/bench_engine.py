@@ -0,0 +1,89 @@
+# engine micro-benchmarks on the headless simulator
+#   python bench/bench_engine.py               run and print
+#   python bench/bench_engine.py --save        write bench/baseline.json, machine specific, not committed
+#   python bench/bench_engine.py --check [pct] fail if any games/sec drops more than pct (default 20) below baseline
+import json, os, sys, time, tracemalloc
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from game.roles import *
+from game.sim import simulate
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+DECKS = {
+    "all": ALL_ROLES,
+    "classic": [WEREWOLF, WEREWOLF, SEER, DOCTOR] + [VILLAGER] * 4 + [WEREWOLF, WITCH, BODYGUARD, HUNTER] + [VILLAGER] * 28,
+    "actions": [WEREWOLF, WOLF_CUB, SEER, AURA_SEER, DOCTOR, BODYGUARD, WITCH, PRIEST, SORCERESS, VAMPIRE, CULT_LEADER,
+                LONE_WOLF, WEREWOLF] + [VILLAGER] * 27,
+}
+PLAYERS = (5, 10, 20, 40)
+
+def pct(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(len(xs) * p))] if xs else 0.0
+
+def bench(deck_name, n, games):
+    deck = DECKS[deck_name]
+    # best of 3, the single-pass number is too noisy to gate on
+    best = float("inf")
+    for _ in range(3):
+        t = time.perf_counter()
+        for s in range(games):
+            simulate(n, deck, seed=s)
+        best = min(best, time.perf_counter() - t)
+    gps = games / best
+    day, night = [], []
+    for s in range(games // 4 or 1):
+        r = simulate(n, deck, seed=s, timed=True)
+        day += r.day_times; night += r.night_times
+    tracemalloc.start()
+    k = 20
+    for s in range(k):
+        simulate(n, deck, seed=s)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # blocks still held by one finished game, the Game plus its players and caches
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = simulate(n, deck, seed=0)
+    diff = tracemalloc.take_snapshot().compare_to(before, "filename")
+    tracemalloc.stop()
+    blocks = sum(st.count_diff for st in diff if st.count_diff > 0)
+    del kept
+    return {
+        "games_per_sec": gps,
+        "day_p50_us": pct(day, 0.5) * 1e6, "day_p99_us": pct(day, 0.99) * 1e6,
+        "night_p50_us": pct(night, 0.5) * 1e6, "night_p99_us": pct(night, 0.99) * 1e6,
+        "peak_kb": peak / 1024, "game_blocks": blocks,
+    }
+
+def main():
+    args = sys.argv[1:]
+    games = int(os.getenv("BENCH_GAMES", "400"))
+    results = {}
+    print(f"{'case':<14}{'games/s':>10}{'day p50':>9}{'p99':>7}{'night p50':>11}{'p99':>7}{'peak KB':>9}{'blocks':>8}")
+    for deck in DECKS:
+        for n in PLAYERS:
+            r = results[f"{deck}/{n}"] = bench(deck, n, games)
+            print(f"{deck + '/' + str(n):<14}{r['games_per_sec']:>10.0f}{r['day_p50_us']:>9.1f}{r['day_p99_us']:>7.1f}"
+                  f"{r['night_p50_us']:>11.1f}{r['night_p99_us']:>7.1f}{r['peak_kb']:>9.1f}{r['game_blocks']:>8}")
+    if "--save" in args:
+        with open(BASELINE, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print(f"baseline written to {BASELINE}")
+    if "--check" in args:
+        i = args.index("--check")
+        limit = float(args[i + 1]) if i + 1 < len(args) else 20.0
+        with open(BASELINE) as f:
+            base = json.load(f)
+        bad = []
+        for case, r in results.items():
+            b = base.get(case)
+            if b and r["games_per_sec"] < b["games_per_sec"] * (1 - limit / 100):
+                bad.append(f"{case} {r['games_per_sec']:.0f} vs {b['games_per_sec']:.0f} games/s")
+        if bad:
+            print("REGRESSION over", limit, "%,", "; ".join(bad))
+            sys.exit(1)
+        print(f"no regression over {limit}%")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# bytes held per game, python bench/bench_layout.py [players] [games] [--dict]
+# builds games to the middle of day 2 (roles dealt, one lynch, one night, votes open) and measures
+# what they keep alive with tracemalloc. --dict keeps each game in the layout from before the slotted
+# classes instead, per-instance __dict__ for Game and PlayerState, one *_target attribute per night
+# action and every role in role_index, so the two can be compared on the same games
+import copy, os, random, sys, tracemalloc
+from dataclasses import fields
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from game.game import Game, LEGACY_NIGHT_FIELDS
+from game.roles import ALL_ROLES
+
+def build(i, n, rng):
+    g = Game(chat_id=-1_000_000 - i, seed=i)
+    for j in range(n):
+        g.add_player(10_000_000 + i * 100 + j, f"player {j}")
+    g.assign_roles(ALL_ROLES)
+    alive = list(g.alive_list())
+    for u in alive:
+        g.vote(u, rng.choice(alive))
+    g.resolve_day()
+    alive = list(g.alive_list())
+    for uid, code in list(g.night_actors()):
+        g.act(code, uid, rng.choice(alive))
+    g.resolve_night()
+    alive = list(g.alive_list())
+    for u in alive[: len(alive) // 2]:
+        g.vote(u, rng.choice(alive))
+    return g
+
+class DictGame:
+    pass
+
+class DictPlayer:
+    pass
+
+def dict_layout(g: Game) -> DictGame:
+    # the same state in the old layout, roles stay the shared singletons
+    memo = {id(r): r for r in ALL_ROLES}
+    old = DictGame()
+    for f in fields(Game):
+        if f.name == "night":
+            continue
+        v = getattr(g, f.name)
+        if f.name == "players":
+            players = {}
+            for uid, ps in v.items():
+                p = players[uid] = DictPlayer()
+                p.user_id, p.name, p.role, p.alive = ps.user_id, ps.name, ps.role, ps.alive
+            v = players
+        else:
+            v = copy.deepcopy(v, memo)
+        setattr(old, f.name, v)
+    for name, code in LEGACY_NIGHT_FIELDS.items():
+        setattr(old, name, g.night.get(code))
+    index = {}
+    for uid in g.alive_list():
+        index.setdefault(g.players[uid].role, set()).add(uid)
+    old.role_index = index
+    return old
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    n = int(args[0]) if len(args) > 0 else 20
+    count = int(args[1]) if len(args) > 1 else 2000
+    as_dict = "--dict" in sys.argv
+    rng = random.Random(3)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    if as_dict:
+        games = [dict_layout(build(i, n, rng)) for i in range(count)]
+    else:
+        games = [build(i, n, rng) for i in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # held to here so the measurement sees them alive
+    del games
+    layout = "dict layout" if as_dict else "slotted layout"
+    print(f"{n}-player game, {layout}, {(after - before) / count:.0f} bytes each over {count} games")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# steady-state RSS with churned lobbies, python bench/bench_memory.py [lobbies] [max_games]
+# every lobby gets /newgame and a few /join through the real handlers, then is abandoned.
+# runs once with eviction off and once with the sweeper capping GAMES at max_games
+import asyncio, gc, os, subprocess, sys
+from types import SimpleNamespace as NS
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import logging
+logging.disable(logging.INFO)
+os.environ.setdefault("STATS_DB", ":memory:")
+os.environ.setdefault("EVENT_LOG", "")
+import bot
+from outbound import OutboundQueue
+
+# the fake bot has no flood limits, take the token buckets and the merge wait out of the measurement
+bot.OUT = OutboundQueue(global_rate=1e9, per_chat_rate=1e9, per_chat_burst=1e9, group_rate=1e9, group_burst=1e9,
+                        merge_window=0)
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+
+class FakeBot:
+    async def send_message(self, chat_id, text, **kw):
+        return NS(message_id=1)
+    async def pin_chat_message(self, **kw):
+        pass
+
+def update(chat_id, uid):
+    user = NS(id=uid, username=None, first_name=f"u{uid}", full_name=f"player {uid}")
+    async def reply_text(*a, **kw):
+        return NS(message_id=1)
+    return NS(effective_chat=NS(id=chat_id), effective_message=NS(message_thread_id=None, reply_text=reply_text),
+              effective_user=user)
+
+async def churn(lobbies, evict, players=6, every=1000):
+    ctx = NS(bot=FakeBot())
+    samples = []
+    for i in range(lobbies):
+        chat_id = -1_000_000_000 - i
+        host = 50_000_000 + i * 100
+        await bot.cmd_newgame(update(chat_id, host), ctx)
+        for j in range(players):
+            await bot.cmd_join(update(chat_id, host + j), ctx)
+        if (i + 1) % every == 0:
+            if evict:
+                bot.sweep()
+            # the store would flush in the background, do it here so dirty games are not held
+            await bot.STORE.flush()
+            if (i + 1) % (lobbies // 10) == 0:
+                gc.collect()
+                samples.append((i + 1, len(bot.GAMES), len(bot.HOWTO_PINNED), len(bot.PLAYER_GAME), rss_mb()))
+    return samples
+
+def run(lobbies, cap, evict):
+    bot.MAX_GAMES = cap if evict else 10**9
+    bot.MAX_PINNED = cap if evict else 10**9
+    print(f"eviction {'on, MAX_GAMES=%d' % cap if evict else 'off'}, start RSS {rss_mb():.1f} MB")
+    print(f"{'lobbies':>9}{'games':>8}{'pinned':>8}{'indexed':>9}{'RSS MB':>9}")
+    for n, games, pinned, idx, rss in asyncio.run(churn(lobbies, evict)):
+        print(f"{n:>9}{games:>8}{pinned:>8}{idx:>9}{rss:>9.1f}")
+
+def main():
+    lobbies = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    cap = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    if len(sys.argv) > 3:
+        run(lobbies, cap, sys.argv[3] == "on")
+        return
+    # one process per mode, RSS does not shrink back after a run
+    for mode in ("off", "on"):
+        sys.stdout.flush()
+        subprocess.run([sys.executable, __file__, str(lobbies), str(cap), mode], check=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+# per-update cost of the metrics wrappers, python bench/bench_metrics.py [calls]
+import asyncio, os, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metrics import Histogram, Registry
+
+async def noop(update, ctx):
+    return None
+
+async def run(n):
+    reg = Registry()
+    timed = reg.instrument("noop", noop)
+    best_raw = best_timed = float("inf")
+    for _ in range(3):
+        t = time.perf_counter()
+        for _ in range(n): await noop(None, None)
+        best_raw = min(best_raw, time.perf_counter() - t)
+        t = time.perf_counter()
+        for _ in range(n): await timed(None, None)
+        best_timed = min(best_timed, time.perf_counter() - t)
+    h = Histogram()
+    t = time.perf_counter()
+    for i in range(n): h.observe((i % 1000) * 1e-4)
+    obs = time.perf_counter() - t
+    for i in range(50): reg.api_call(f"m{i % 8}", 0.01, True)
+    t = time.perf_counter()
+    body = reg.render()
+    render = time.perf_counter() - t
+    print(f"handler wrapper {(best_timed - best_raw) / n * 1e6:.2f} us/update, observe {obs / n * 1e6:.2f} us, "
+          f"render {render * 1e3:.2f} ms for {len(body.splitlines())} lines")
+
+if __name__ == "__main__":
+    asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 200000))
@@ -0,0 +1,57 @@
+# night resolution in a batch, python bench/bench_night.py [games] [players] [rounds]
+# deals games with every night-action role, has every actor act, snapshots them at night, then resolves
+# the whole batch from the snapshots round after round. Reports nights/sec with the pipeline's usual stage
+# sampling, then times every night to break the cost down by stage
+import os, random, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from game.roles import *
+from game.game import Game, NIGHT
+from game.night import STAGES
+
+DECK = [WEREWOLF, WOLF_CUB, SEER, AURA_SEER, DOCTOR, BODYGUARD, WITCH, PRIEST, SORCERESS, VAMPIRE, CULT_LEADER,
+        LONE_WOLF, WEREWOLF]
+
+def night_snapshot(rng, i, n):
+    g = Game(chat_id=-i - 1, seed=i)
+    for u in range(n):
+        g.add_player(1000 + u, f"p{u}")
+    g.assign_roles(DECK)
+    g.phase = "night"
+    g.open_night()
+    alive = g.alive_list()
+    for uid, code in list(g.night_actors()):
+        g.act(code, uid, rng.choice(alive))
+    return g.to_state()
+
+def main():
+    games = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    players = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    rng = random.Random(5)
+    snaps = [night_snapshot(rng, i, players) for i in range(games)]
+    def resolve_all():
+        total = 0.0
+        for _ in range(rounds):
+            batch = [Game.from_state(s) for s in snaps]
+            t = time.perf_counter()
+            for g in batch:
+                g.resolve_night()
+            total += time.perf_counter() - t
+        return total
+    nights = games * rounds
+    total = resolve_all()
+    print(f"{nights} nights ({games} games x {players} players x {rounds} rounds) in {total:.2f}s, "
+          f"{nights / total:.0f} nights/s, {total / nights * 1e6:.1f} us/night, 1 in {NIGHT.sample} timed")
+    NIGHT.sample = 1
+    NIGHT.totals = [0.0] * len(STAGES); NIGHT.timed = 0
+    total = resolve_all()
+    mean = NIGHT.seconds()
+    staged = sum(mean.values())
+    print(f"every night timed, {total / nights * 1e6:.1f} us/night")
+    for s in STAGES:
+        hooks = ", ".join(fn.__name__ for fn, _ in NIGHT.hooks[s])
+        print(f"  {s:<8} {mean[s] * 1e6:6.2f} us/night {mean[s] / staged:6.1%}  {hooks}")
+    print(f"  outside the stages {total / nights * 1e6 - staged * 1e6:.2f} us/night (text, win check, timing)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# event log replay, python bench/bench_replay.py [event log files...]
+# with files, replays every complete game they hold at full speed through the engine and checks each
+# one's faction counters against a recount. Without, records a corpus of simulated games in the same
+# format first, and also checks every replay against the game that was recorded. Exits 1 on a mismatch
+# rotated files go oldest first, a game's lines are read in file order
+#   python bench/bench_replay.py events.log.2 events.log.1 events.log
+#   GAMES=5000 python bench/bench_replay.py
+import os, sys, tempfile, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from game.roles import ALL_ROLES
+from game.sim import simulate, recount_teams
+from game.replay import replay, engine_state, read_logs, dump_line
+
+def record_corpus(path, games):
+    # sim games of 5 to 20 players, the reference states kept for the exactness check
+    want = {}
+    with open(path, "w", encoding="utf-8") as f:
+        for s in range(games):
+            g = simulate(5 + s % 16, ALL_ROLES, seed=s, record=True).game
+            gid = (g.chat_id, g.thread_id, g.gid)
+            # split the log over two lines like a flush mid-game would
+            half = len(g.events) // 2
+            f.write(dump_line(gid, g.events[:half]))
+            f.write(dump_line(gid, g.events[half:]))
+            want[gid] = engine_state(g)
+    return want
+
+def main():
+    paths = sys.argv[1:]
+    want = None
+    tmp = None
+    if not paths:
+        tmp = tempfile.NamedTemporaryFile(suffix=".log", delete=False)
+        tmp.close()
+        games = int(os.getenv("GAMES", "2000"))
+        t = time.perf_counter()
+        want = record_corpus(tmp.name, games)
+        print(f"recorded {games} simulated games in {time.perf_counter() - t:.2f}s, "
+              f"{os.path.getsize(tmp.name) / games:.0f} bytes per game")
+        paths = [tmp.name]
+    try:
+        t = time.perf_counter()
+        logs = read_logs(paths)
+        parse = time.perf_counter() - t
+        # a log that starts mid-game, from before recording was on, cannot be replayed
+        complete = {k: evs for k, evs in logs.items() if evs and evs[0][0] == "g"}
+        events = sum(len(evs) for evs in complete.values())
+        print(f"{len(logs)} games in {len(paths)} file(s), {len(complete)} complete, {events} events, parsed in {parse:.2f}s")
+        t = time.perf_counter()
+        out = [replay(k, evs) for k, evs in complete.items()]
+        run = time.perf_counter() - t
+        print(f"replayed {len(out) / run:.0f} games/s, {events / run:.0f} events/s, {run / max(events, 1) * 1e6:.2f} us/event")
+        bad = [g.key for g in out if g.phase != "lobby" and g.team_alive != recount_teams(g)]
+        if want is not None:
+            bad += [g.key for g in out if engine_state(g) != want[(g.chat_id, g.thread_id, g.gid)]]
+        ended = sum(1 for g in out if g.phase == "end")
+        print(f"{ended} replayed games ended, mismatches {len(bad)}")
+        if bad:
+            print("mismatched games", bad[:10])
+            sys.exit(1)
+    finally:
+        if tmp:
+            os.unlink(tmp.name)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+# phase deadline scheduler, python bench/bench_scheduler.py [games] [spread seconds]
+# arms one deadline per game spread over the window, reschedules half of them once (a phase change),
+# then reports schedule cost and how late each deadline fired
+import asyncio, os, random, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scheduler import PhaseScheduler
+
+def pct(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(len(xs) * p))] if xs else 0.0
+
+async def run(games, spread):
+    rng = random.Random(3)
+    late = []
+    want = {}
+    async def on_due(k):
+        late.append(time.time() - want[k])
+    s = PhaseScheduler(on_due)
+    s.start()
+    t0 = time.time() + 0.5
+    t = time.perf_counter()
+    for k in range(games):
+        want[k] = t0 + rng.random() * spread
+        s.schedule(k, want[k])
+    for k in range(0, games, 2):
+        want[k] = t0 + rng.random() * spread
+        s.schedule(k, want[k])
+    per_op = (time.perf_counter() - t) / (games * 1.5)
+    while len(late) < games:
+        await asyncio.sleep(0.05)
+    s.stop()
+    print(f"{games} games over {spread:.0f}s, schedule {per_op * 1e6:.2f} us/op, fired {s.fired}, "
+          f"heap left {len(s.heap)}, lateness p50 {pct(late, 0.5) * 1e3:.2f} ms p99 {pct(late, 0.99) * 1e3:.2f} ms "
+          f"max {max(late) * 1e3:.2f} ms")
+
+def main():
+    games = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    spread = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+    asyncio.run(run(games, spread))
+
+if __name__ == "__main__":
+    main()
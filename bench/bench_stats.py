@@ -0,0 +1,102 @@
+# stats store at scale, python bench/bench_stats.py [games] [users] [chats]
+# records synthetic finished games in flush-sized batches into a fresh sqlite file, then times /stats and
+# /leaderboard reads against the full history, and one history scan for the same answer as a yardstick
+import json, os, random, sys, tempfile, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from game.roles import ALL_ROLES, Alignment
+from game.game import ALIGNMENT_TEAM
+from stats import StatsStore
+
+BATCH = 2000  # about one flush on a busy bot
+
+def pct(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(len(xs) * p))] if xs else 0.0
+
+def records(rng, games, users, chats):
+    # busy chats host most games, each chat draws its players from its own regulars
+    roles = [(r.name, ALIGNMENT_TEAM[r.alignment]) for r in ALL_ROLES]
+    wolves = [x for x in roles if x[1] == ALIGNMENT_TEAM[Alignment.WOLF]]
+    winners = ["village"] * 5 + ["wolves"] * 4 + ["vampires", "cult", "draw"]
+    members = {}
+    now = time.time()
+    for i in range(games):
+        c = int(chats * rng.random() ** 2)
+        pool = members.get(c)
+        if pool is None:
+            pool = members[c] = [int(users * rng.random() ** 2) + 1 for _ in range(rng.randint(16, 60))]
+        uids = set(rng.sample(pool, rng.randint(5, 16)))
+        deck = rng.sample(wolves, 1) + [rng.choice(roles) for _ in range(len(uids) - 1)]
+        winner = rng.choice(winners)
+        seats = []
+        for uid, (role, team) in zip(uids, deck):
+            alive = rng.random() < 0.35
+            seats.append((uid, f"player {uid}", role, team, alive, not alive and rng.random() < 0.4, team == winner))
+        yield (-1000000000000 - c, 0, now + i, rng.randint(1, 6), winner, seats)
+
+def timed(fn, args):
+    lat = []
+    for a in args:
+        t = time.perf_counter()
+        fn(*a)
+        lat.append(time.perf_counter() - t)
+    return lat
+
+def main():
+    games = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+    chats = int(sys.argv[3]) if len(sys.argv) > 3 else 20000
+    rng = random.Random(11)
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "stats.db")
+        s = StatsStore(path)
+        t = time.perf_counter()
+        batch, done, seen_users, seen_chats = [], 0, [], []
+        for r in records(rng, games, users, chats):
+            batch.append(r)
+            if len(batch) == BATCH:
+                s.write(batch)
+                done += len(batch)
+                seen_chats.append(batch[0][0])
+                seen_users.append(batch[0][5][0][0])
+                batch = []
+                if done % 100000 == 0:
+                    print(f"  {done} games, {done / (time.perf_counter() - t):.0f} games/s", flush=True)
+        if batch:
+            s.write(batch)
+        write = time.perf_counter() - t
+        size = sum(os.path.getsize(os.path.join(d, f)) for f in os.listdir(d)) / 1e6
+        print(f"{games} games recorded in {write:.1f}s, {games / write:.0f} games/s, "
+              f"{write / games * 1e6:.0f} us/game with all totals, {size:.0f} MB on disk")
+
+        probe = [(rng.choice(seen_users),) for _ in range(5000)]
+        cprobe = [(rng.choice(seen_chats),) for _ in range(2000)]
+        rows = [
+            ("user totals", timed(s.user, probe)),
+            ("user roles", timed(s.user_roles, probe)),
+            ("user in chat", timed(s.chat_user, [(c, u) for (c,), (u,) in zip(cprobe, probe)])),
+            ("chat totals", timed(s.chat, cprobe)),
+            ("global leaderboard", timed(s.leaderboard, [(None, 10)] * 2000)),
+            ("chat leaderboard", timed(s.leaderboard, [(c, 10) for (c,) in cprobe])),
+        ]
+        for name, lat in rows:
+            print(f"{name:<20} p50 {pct(lat, 0.5) * 1e6:7.1f} us  p99 {pct(lat, 0.99) * 1e6:7.1f} us")
+
+        # the same /stats answer from history alone, what the totals save
+        uid = probe[0][0]
+        t = time.perf_counter()
+        n = w = 0
+        for (seats,) in s.rdb.execute("SELECT seats FROM results"):
+            for seat in json.loads(seats):
+                if seat[0] == uid:
+                    n += 1; w += seat[5]
+        scan = time.perf_counter() - t
+        st = s.user(uid)
+        ok = (st["games"], st["wins"]) == (n, w)
+        print(f"history scan for one user {scan:.2f}s, totals match: {ok}")
+        s.db.close(); s.rdb.close()
+        if not ok:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
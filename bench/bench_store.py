@@ -0,0 +1,50 @@
+# recovery time with many stored games, python bench/bench_store.py [games]
+import os, random, sys, tempfile, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from game.game import Game
+from game.roles import ALL_ROLES
+from store import SQLiteBackend, GameStore, dumps
+
+def make_game(i, rng):
+    g = Game(chat_id=-100000 - i)
+    n = rng.randint(5, 20)
+    for j in range(n):
+        g.add_player(i * 100 + j, f"player{j}")
+    if rng.random() < 0.8:
+        g.assign_roles(ALL_ROLES)
+        alive = list(g.alive_list())
+        for uid in alive[: rng.randint(0, n // 2)]:
+            g.vote(uid, rng.choice(alive))
+    return g
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rng = random.Random(1)
+    path = os.path.join(tempfile.mkdtemp(), "games.db")
+    games = [make_game(i, rng) for i in range(n)]
+    b = SQLiteBackend(path)
+    t = time.perf_counter()
+    b.save_many({g.key: (dumps(g), list(g.players), g.deadline) for g in games})
+    print(f"write {n} games, {time.perf_counter() - t:.3f}s, db {os.path.getsize(path) / 1e6:.1f} MB")
+    b.close()
+
+    # process restart, open the store and serve the first update
+    t = time.perf_counter()
+    store = GameStore(SQLiteBackend(path))
+    store.backend.load_pinned()
+    ready = time.perf_counter() - t
+    keys = [g.key for g in games]
+    rng.shuffle(keys)
+    lat = []
+    for k in keys:
+        t1 = time.perf_counter()
+        g = store.load(k)
+        lat.append(time.perf_counter() - t1)
+        assert g is not None
+    lat.sort()
+    print(f"startup to first update, {ready * 1e3:.2f} ms")
+    print(f"lazy rehydrate per game, p50 {lat[len(lat) // 2] * 1e6:.0f} us, p99 {lat[int(len(lat) * 0.99)] * 1e6:.0f} us")
+    print(f"rehydrate all {n}, {sum(lat):.3f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# consistent-hash sharding check, python bench/check_sharding.py [games] [max workers]
+# for each N, hashes synthetic game keys onto N and N+1 workers and checks that only about 1/(N+1) of the
+# games move, that every moved game lands on the new worker, and that load stays even. Also checks that
+# a game's group updates, DM night buttons and role deep link all route to the same worker. Exits 1 on failure
+import os, random, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shard import HashRing, game_key, route_key
+
+SLACK = 1.25       # moved fraction may be up to this times the ideal 1/(N+1)
+MAX_SKEW = 1.35    # busiest worker over the mean
+
+def keys(games):
+    rng = random.Random(7)
+    # supergroup ids, a tenth of them forum topics
+    return [game_key(-1000000000000 - rng.randrange(10**10), rng.randrange(1, 500) if rng.random() < 0.1 else 0)
+            for _ in range(games)]
+
+def check_moves(ks, n):
+    a, b = HashRing(range(n)), HashRing(range(n + 1))
+    t = time.perf_counter()
+    before = [a.node_for(k) for k in ks]
+    per_key = (time.perf_counter() - t) / len(ks)
+    after = [b.node_for(k) for k in ks]
+    moved = [(x, y) for x, y in zip(before, after) if x != y]
+    frac = len(moved) / len(ks)
+    ideal = 1 / (n + 1)
+    load = [0] * (n + 1)
+    for y in after:
+        load[y] += 1
+    skew = max(load) / (len(ks) / (n + 1))
+    stray = sum(1 for _, y in moved if y != n)
+    ok = frac <= ideal * SLACK and not stray and skew <= MAX_SKEW
+    print(f"{n:>2} -> {n + 1:<2} moved {frac:6.2%} (ideal {ideal:6.2%})  to new worker {len(moved) - stray}/{len(moved)}  "
+          f"skew {skew:.2f}  lookup {per_key * 1e6:.2f} us  {'ok' if ok else 'FAIL'}")
+    return ok
+
+def check_routes():
+    # one game's traffic, as Telegram sends it
+    chat, thread, uid = -1001234567890, 42, 555
+    group = {"id": chat, "type": "supergroup"}
+    dm = {"id": uid, "type": "private"}
+    who = {"id": uid, "is_bot": False, "first_name": "p"}
+    ups = [
+        {"message": {"message_id": 1, "chat": group, "from": who, "message_thread_id": thread, "text": "/join"}},
+        {"callback_query": {"id": "1", "from": who, "data": "v:1:2:3",
+                            "message": {"message_id": 2, "chat": group, "message_thread_id": thread}}},
+        {"callback_query": {"id": "2", "from": who, "data": f"k:1:2:3:{chat:x}:{thread:x}",
+                            "message": {"message_id": 3, "chat": dm}}},
+        {"message": {"message_id": 4, "chat": dm, "from": who, "text": f"/start role_{chat}_{thread}"}},
+    ]
+    got = {route_key(u) for u in ups}
+    ok = got == {game_key(chat, thread)}
+    ok &= route_key({"message": {"message_id": 5, "chat": dm, "from": who, "text": "hi"}}) == f"u{uid}"
+    ok &= route_key({"my_chat_member": {"chat": group, "from": who}}) is None
+    print(f"routing, one game's group, DM button and deep link updates share a key: {'ok' if ok else 'FAIL'}")
+    return ok
+
+def main():
+    games = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    top = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    ks = keys(games)
+    ok = check_routes()
+    for n in range(1, top):
+        ok &= check_moves(ks, n)
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
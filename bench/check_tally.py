@@ -0,0 +1,77 @@
+# incremental vote tally check, python bench/check_tally.py [sequences] [games]
+# drives Tally with random vote and change-vote sequences and after every step compares counts, leaders()
+# in order, leader() and plurality() against a from-scratch recount of the vote history. Then plays seeded
+# sim games with simulate(check=True), which checks the day tally and wolf_tally.leaders() at every vote.
+# Exits 1 on a mismatch
+import os, random, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from game.tally import Tally
+from game.roles import ALL_ROLES
+from game.sim import simulate
+
+def reference(history):
+    # counts from the votes standing at the end, leaders ordered by the step that last moved their count,
+    # the order a target reaches its count in. A change of vote takes from the old target before the new one
+    votes, last = {}, {}
+    for i, (voter, target) in enumerate(history):
+        old = votes.get(voter)
+        if old is not None:
+            last[old] = 2 * i
+        votes[voter] = target
+        last[target] = 2 * i + 1
+    counts = {}
+    for t in votes.values():
+        counts[t] = counts.get(t, 0) + 1
+    top = max(counts.values(), default=0)
+    leaders = sorted((t for t, n in counts.items() if n == top), key=last.__getitem__)
+    return counts, leaders
+
+def check_sequence(rng, steps, voters, targets):
+    t = Tally()
+    votes, history = {}, []
+    for step in range(steps):
+        if rng.random() < 0.01:
+            # a phase ends
+            t.clear(); votes.clear(); history.clear()
+        voter = rng.randrange(voters)
+        target = rng.choice(targets)
+        t.change(votes.get(voter), target)
+        votes[voter] = target
+        history.append((voter, target))
+        counts, leaders = reference(history)
+        got = t.leaders()
+        want_leader = (leaders[0], False) if len(leaders) == 1 else (None, True)
+        if t.counts != counts or got != leaders or t.leader() != want_leader or t.plurality() != leaders[0]:
+            return (f"step {step}, counts {t.counts} want {counts}, leaders {got} want {leaders}, "
+                    f"leader {t.leader()} want {want_leader}, plurality {t.plurality()}")
+    return None
+
+def main():
+    sequences = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    games = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    rng = random.Random(4)
+    t = time.perf_counter()
+    bad = 0
+    for i in range(sequences):
+        # few targets make ties and lead changes common
+        voters = rng.randint(1, 16)
+        targets = list(range(rng.randint(1, 8))) + ["skip"]
+        err = check_sequence(rng, rng.randint(1, 150), voters, targets)
+        if err:
+            bad += 1
+            if bad <= 5: print(f"sequence {i}: {err}")
+    print(f"{sequences} random vote sequences in {time.perf_counter() - t:.2f}s, mismatches {bad}")
+    t = time.perf_counter()
+    failed = 0
+    for s in range(games):
+        try:
+            simulate(5 + s % 16, ALL_ROLES, seed=s, revote_rate=0.5, check=True)
+        except AssertionError as e:
+            failed += 1
+            if failed <= 5: print(f"sim seed {s}: {e}")
+    print(f"{games} sim games with tally checks in {time.perf_counter() - t:.2f}s, mismatches {failed}")
+    if bad or failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# in-process stand-in for the Telegram Bot API, plugs into PTB as its request backend so the
+# real Bot serialization path runs, answers every method locally and records what was sent
+import contextvars, itertools, json, time
+from typing import Dict, List, Optional, Tuple
+from telegram.request import BaseRequest
+
+# phase label for outbound call accounting, set by the load generator around each update
+PHASE = contextvars.ContextVar("phase", default="other")
+
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Werewolf", "username": "werewolf_test_bot"}
+
+class FakeTelegram(BaseRequest):
+    def __init__(self):
+        self.msg_ids = itertools.count(1)
+        self.calls: Dict[str, int] = {}
+        self.by_phase: Dict[str, Dict[str, int]] = {}
+        # chat id -> last inline keyboard sent there, and its message id
+        self.keyboards: Dict[int, Tuple[int, list]] = {}
+        # DM chat id -> its last few keyboards, a player with two night prompts gets two at once
+        self.dm_keyboards: Dict[int, List[Tuple[int, list]]] = {}
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _message(self, p: dict) -> dict:
+        chat_id = int(p["chat_id"])
+        mid = int(p.get("message_id") or next(self.msg_ids))
+        markup = p.get("reply_markup")
+        if isinstance(markup, str):
+            markup = json.loads(markup)
+        if markup and "inline_keyboard" in markup:
+            self.keyboards[chat_id] = (mid, markup["inline_keyboard"])
+            if chat_id > 0:
+                kbs = self.dm_keyboards.setdefault(chat_id, [])
+                kbs.append(self.keyboards[chat_id])
+                del kbs[:-4]
+        chat = {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"}
+        return {"message_id": mid, "date": int(time.time()), "chat": chat, "text": p.get("text", "")}
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        name = url.rsplit("/", 1)[-1]
+        self.calls[name] = self.calls.get(name, 0) + 1
+        ph = self.by_phase.setdefault(PHASE.get(), {})
+        ph[name] = ph.get(name, 0) + 1
+        p = request_data.parameters if request_data else {}
+        if name == "getMe":
+            result = BOT_USER
+        elif name in ("sendMessage", "editMessageText"):
+            result = self._message(p)
+        elif name == "getChatMember":
+            result = {"status": "creator", "user": {"id": int(p["user_id"]), "is_bot": False, "first_name": "u"}, "is_anonymous": False}
+        elif name == "getChatAdministrators":
+            result = [{"status": "creator", "user": {"id": 1, "is_bot": False, "first_name": "owner"}, "is_anonymous": False}]
+        else:
+            # answerCallbackQuery, pinChatMessage, setMyCommands, deleteWebhook ...
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
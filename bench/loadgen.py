@@ -0,0 +1,173 @@
+# end-to-end load through build_app() against the in-process fake Bot API
+#   python bench/loadgen.py [groups] [players] [days] [--limits] [--early]
+# every simulated group plays lobby, joins, /startgame, then day votes and night DM actions,
+# bursts inside a group are sent concurrently like real taps. --limits keeps the outbound token buckets,
+# --early sends no /nextphase and waits for the early close after the last vote or action instead
+import asyncio, itertools, os, random, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("BOT_TOKEN", "123456:LOADTEST")
+os.environ.setdefault("BALANCE_DECKS", "0")
+os.environ.setdefault("STATS_DB", ":memory:")
+os.environ.setdefault("EVENT_LOG", "")
+os.environ.setdefault("VOTE_PANEL_DELAY", "0.2")
+if "--early" in sys.argv:
+    os.environ.setdefault("EARLY_CLOSE_GRACE", "0")
+import logging
+logging.disable(logging.INFO)
+from telegram import Update
+import bot
+from outbound import OutboundQueue
+from fakeapi import FakeTelegram, PHASE
+
+rng = random.Random(11)
+update_ids = itertools.count(1)
+message_ids = itertools.count(1)
+
+def user(uid):
+    return {"id": uid, "is_bot": False, "first_name": f"u{uid}", "username": f"u{uid}"}
+
+def chat(chat_id):
+    return {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup", "title": "loadtest"}
+
+def command(chat_id, uid, cmd):
+    text = "/" + cmd
+    return {"update_id": next(update_ids), "message": {
+        "message_id": next(message_ids), "date": int(time.time()), "chat": chat(chat_id), "from": user(uid),
+        "text": text, "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}]}}
+
+def press(chat_id, uid, message_id, data):
+    return {"update_id": next(update_ids), "callback_query": {
+        "id": str(next(update_ids)), "from": user(uid), "chat_instance": str(chat_id), "data": data,
+        "message": {"message_id": message_id, "date": int(time.time()), "chat": chat(chat_id), "text": "k"}}}
+
+class Load:
+    def __init__(self, app, api):
+        self.app, self.api = app, api
+        self.lat = []
+        self.updates = 0
+        self.early = False
+        self.close_lat = []  # first tap of the burst to the next phase being open, --early only
+
+    async def feed(self, phase, data):
+        PHASE.set(phase)
+        u = Update.de_json(data, self.app.bot)
+        t = time.perf_counter()
+        await self.app.process_update(u)
+        self.lat.append(time.perf_counter() - t)
+        self.updates += 1
+
+    async def burst(self, phase, items):
+        await asyncio.gather(*(self.feed(phase, d) for d in items))
+
+    def buttons(self, chat_id, since=0):
+        kb = self.api.keyboards.get(chat_id)
+        if not kb or kb[0] <= since:
+            return None, []
+        return kb[0], [b["callback_data"] for row in kb[1] for b in row if "callback_data" in b]
+
+    async def next_prompts(self, uid, since, n, timeout=30):
+        # the n DM keyboards newer than since, as (message id, callback data)
+        t = time.perf_counter()
+        while n:
+            kbs = [(m, [b["callback_data"] for row in kb for b in row if "callback_data" in b])
+                   for m, kb in self.api.dm_keyboards.get(uid, ()) if m > since]
+            if len(kbs) >= n or time.perf_counter() - t > timeout:
+                return kbs
+            await asyncio.sleep(0.001)
+        return []
+
+    async def next_buttons(self, chat_id, since, timeout=30):
+        # keyboards are queued under the game lock and sent after, wait for one newer than since
+        t = time.perf_counter()
+        while True:
+            m, d = self.buttons(chat_id, since)
+            if d or time.perf_counter() - t > timeout:
+                return m, d
+            await asyncio.sleep(0.001)
+
+    async def end_phase(self, label, chat_id, host, g, phase, day, t):
+        # phase and day as they were before the taps, t when the taps went out
+        if not self.early:
+            await self.feed(label, command(chat_id, host, "nextphase"))
+            return
+        PHASE.set(label)
+        # changed phase and the timer task let go of the game, the next prompts are queued
+        while (g.phase == phase and g.day == day or g.key in bot.LOCKS.locks) and time.perf_counter() - t < 5:
+            await asyncio.sleep(0.001)
+        self.close_lat.append(time.perf_counter() - t)
+
+    async def group(self, i, players, days):
+        chat_id = -1000000000 - i
+        host = 10_000_000 + i * 1000
+        uids = [host + j for j in range(players)]
+        await self.feed("lobby", command(chat_id, host, "newgame"))
+        await self.burst("lobby", [command(chat_id, u, "join") for u in uids])
+        await self.feed("start", command(chat_id, host, "startgame"))
+        g = bot.GAMES.get((chat_id, 0))
+        mid = 0
+        for _ in range(days):
+            if not g or g.phase != "day" or len(g.alive_set) <= 2:
+                break
+            mid, data = await self.next_buttons(chat_id, mid)
+            if not data:
+                break
+            day, t = g.day, time.perf_counter()
+            await self.burst("day", [press(chat_id, u, mid, rng.choice(data)) for u in list(g.alive_list())])
+            mark = max(self.api.keyboards.get(chat_id, (0,))[0], 0)
+            await self.end_phase("day_end", chat_id, host, g, "day", day, t)
+            if g.phase != "night":
+                break
+            taps = []
+            prompts = {}
+            for u, _ in g.night_actors():
+                prompts[u] = prompts.get(u, 0) + 1
+            for u in list(g.alive_list()):
+                # one tap on every prompt, the night waits for each of them
+                for m, d in await self.next_prompts(u, mark, prompts.get(u, 0)):
+                    taps.append(press(u, u, m, rng.choice(d)))
+            t = time.perf_counter()
+            await self.burst("night", taps)
+            await self.end_phase("night_end", chat_id, host, g, "night", day, t)
+
+async def run(groups, players, days, limits, early):
+    if not limits:
+        bot.OUT = OutboundQueue(global_rate=1e9, per_chat_rate=1e9, per_chat_burst=1e9, group_rate=1e9, group_burst=1e9)
+    api = FakeTelegram()
+    app = bot.build_app(request=api)
+    await app.initialize()
+    await app.post_init(app)
+    load = Load(app, api)
+    load.early = early
+    t = time.perf_counter()
+    await asyncio.gather(*(load.group(i, players, days) for i in range(groups)))
+    wall = time.perf_counter() - t
+    # let debounced vote panel edits land before counting calls
+    await asyncio.sleep(float(os.environ["VOTE_PANEL_DELAY"]) + 0.1)
+    out = bot.OUT.stats()
+    await app.post_shutdown(app)
+    await app.shutdown()
+    lat = sorted(load.lat)
+    print(f"{groups} groups x {players} players, {load.updates} updates in {wall:.2f}s, {load.updates / wall:.0f} updates/s")
+    print(f"handler latency p50 {lat[len(lat) // 2] * 1e3:.2f} ms, p99 {lat[int(len(lat) * 0.99)] * 1e3:.2f} ms, max {lat[-1] * 1e3:.2f} ms")
+    if load.close_lat:
+        cl = sorted(load.close_lat)
+        print(f"early close, tap burst to next phase p50 {cl[len(cl) // 2] * 1e3:.2f} ms, p99 {cl[int(len(cl) * 0.99)] * 1e3:.2f} ms")
+    print(f"outbound queue, {out['sent']} sends, {out['merged']} texts merged, {out['retried']} retries, {out['failed']} failed, "
+          f"wait p50/p99 prompt {out['wait_prompt_p50'] * 1e3:.1f}/{out['wait_prompt_p99'] * 1e3:.1f} ms, "
+          f"phase {out['wait_phase_p50'] * 1e3:.1f}/{out['wait_phase_p99'] * 1e3:.1f} ms, chat {out['wait_chat_p50'] * 1e3:.1f}/{out['wait_chat_p99'] * 1e3:.1f} ms")
+    print("outbound API calls per game, by phase")
+    for phase, calls in api.by_phase.items():
+        total = sum(calls.values())
+        detail = ", ".join(f"{k} {v / groups:.1f}" for k, v in sorted(calls.items(), key=lambda kv: -kv[1]))
+        print(f"  {phase:<10}{total / groups:>7.1f}  {detail}")
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    groups = int(args[0]) if len(args) > 0 else 1000
+    players = int(args[1]) if len(args) > 1 else 12
+    days = int(args[2]) if len(args) > 2 else 3
+    asyncio.run(run(groups, players, days, "--limits" in sys.argv, "--early" in sys.argv))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+# concurrent update stress for the per-game locks, python bench/stress_serial.py [games] [players]
+# drives the bot handlers with fake updates, every await on the fake bot yields to other updates
+import asyncio, os, random, sys, time
+from types import SimpleNamespace as NS
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BALANCE_DECKS", "0")
+os.environ.setdefault("STATS_DB", ":memory:")
+os.environ.setdefault("EVENT_LOG", "")
+os.environ.setdefault("VOTE_PANEL_DELAY", "0.01")
+import logging
+logging.disable(logging.INFO)
+import bot
+from game.game import Game
+from outbound import OutboundQueue
+
+# the fake bot has no flood limits, take the token buckets out of the measurement
+bot.OUT = OutboundQueue(global_rate=1e9, per_chat_rate=1e9, per_chat_burst=1e9, group_rate=1e9, group_burst=1e9)
+
+rng = random.Random(7)
+
+async def jitter():
+    await asyncio.sleep(rng.random() * 0.002)
+
+class FakeBot:
+    username = "werewolf_bot"
+    def __init__(self):
+        self.calls = 0
+    async def send_message(self, chat_id, text, **kw):
+        self.calls += 1; await jitter()
+        return NS(message_id=self.calls)
+    async def edit_message_text(self, *a, **kw):
+        self.calls += 1; await jitter()
+    async def get_chat_administrators(self, chat_id):
+        # the racing /startgame callers, see play()
+        self.calls += 1; await jitter()
+        return [NS(user=NS(id=chat_id * 1000 + 500 + i)) for i in range(3)]
+
+def make_update(chat_id, uid, text=None, data=None):
+    user = NS(id=uid, username=None, first_name=f"u{uid}", full_name=f"u{uid}")
+    async def reply_text(*a, **kw):
+        await jitter(); return NS(message_id=0)
+    msg = NS(message_thread_id=None, text=text, reply_text=reply_text)
+    async def answer(*a, **kw):
+        await jitter()
+    q = NS(from_user=user, data=data, answer=answer, edit_message_text=reply_text) if data else None
+    return NS(effective_chat=NS(id=chat_id), effective_message=msg, effective_user=user, callback_query=q)
+
+def handlers(serial):
+    wrap = bot.serialized if serial else (lambda fn, key_fn=None: fn)
+    return NS(newgame=wrap(bot.cmd_newgame), join=wrap(bot.cmd_join), startgame=wrap(bot.cmd_startgame),
+              vote=wrap(bot.handle_vote), nextphase=wrap(bot.cmd_nextphase),
+              action=wrap(bot.handle_action_button, bot.dm_key), night2day=wrap(bot.cmd_nextday))
+
+async def play(h, ctx, chat_id, n, starts):
+    host = chat_id * 1000
+    await h.newgame(make_update(chat_id, host), ctx)
+    uids = [host + i for i in range(n)]
+    await asyncio.gather(*(h.join(make_update(chat_id, u), ctx) for u in uids))
+    # several admins race to start the same lobby
+    await asyncio.gather(*(h.startgame(make_update(chat_id, host + 500 + i), ctx) for i in range(3)))
+    g = bot.GAMES[(chat_id, 0)]
+    alive = list(g.alive_list())
+    # everyone votes, a third change their mind, all at once
+    presses = [(u, rng.choice(alive)) for u in alive] + [(u, rng.choice(alive)) for u in alive[: len(alive) // 3]]
+    rng.shuffle(presses)
+    await asyncio.gather(*(h.vote(make_update(chat_id, u, data=bot.button_data(g, "vote", g.seats[t])), ctx) for u, t in presses))
+    final = {}
+    for u, t in presses: final[u] = t
+    lost = sum(1 for u, t in final.items() if g.votes.get(u) != t)
+    await h.nextphase(make_update(chat_id, host), ctx)
+    # wolves vote and the host double-taps night2day
+    wolves = [u for u in g.wolves if g.is_alive(u)]
+    alive = list(g.alive_list())
+    await asyncio.gather(*(h.action(make_update(u, u, data=bot.button_data(g, "kill", g.seats[rng.choice(alive)])), ctx) for u in wolves))
+    day = g.day
+    await asyncio.gather(*(h.night2day(make_update(chat_id, host), ctx) for _ in range(3)))
+    # one night2day moves the day on by one, unless the night decided the game
+    return starts.get((chat_id, 0), 0), lost, 1 if g.phase == "end" else g.day - day
+
+async def run(serial, games, players):
+    bot.GAMES.clear(); bot.PLAYER_GAME.clear(); bot.LOCKS.locks.clear(); bot.ADMINS.d.clear()
+    starts = {}
+    orig = Game.assign_roles
+    def counting(self, deck):
+        starts[self.key] = starts.get(self.key, 0) + 1
+        return orig(self, deck)
+    Game.assign_roles = counting
+    ctx = NS(bot=FakeBot())
+    t = time.perf_counter()
+    try:
+        res = await asyncio.gather(*(play(handlers(serial), ctx, 1 + i, players, starts) for i in range(games)))
+    finally:
+        Game.assign_roles = orig
+        await bot.OUT.drain()
+    dt = time.perf_counter() - t
+    double_start = sum(1 for s, _, _ in res if s != 1)
+    lost = sum(l for _, l, _ in res)
+    bad_day = sum(1 for _, _, d in res if d != 1)
+    print(f"{'serialized' if serial else 'unserialized'}, {games} games x {players} players, {dt:.2f}s, "
+          f"double starts {double_start}, lost votes {lost}, wrong night2day transitions {bad_day}, locks left {len(bot.LOCKS)}")
+    return double_start == 0 and lost == 0 and bad_day == 0 and len(bot.LOCKS) == 0
+
+def main():
+    games = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    players = int(sys.argv[2]) if len(sys.argv) > 2 else 12
+    asyncio.run(run(False, games, players))
+    ok = asyncio.run(run(True, games, players))
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
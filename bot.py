@@ -1,10 +1,25 @@
 
-import os, asyncio, logging, random
-from typing import Dict, Tuple
+import os, asyncio, functools, json, logging, multiprocessing, random, secrets, signal, time
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, BotCommand
-from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, CallbackQueryHandler, filters
-from game.game import Game
-from game.roles import ALL_ROLES
+from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, CallbackQueryHandler, ChatMemberHandler, filters
+from telegram.error import BadRequest, Forbidden
+from game.game import Game, NIGHT, NIGHT_ACTIONS
+from game.night import STAGES
+from game import replay
+from game.balance import DeckCache
+from outbound import OutboundQueue, GLOBAL_RATE, PROMPT, PHASE, CHAT
+from cache import GameLRU, AsyncTTLCache
+from store import GameStore, backend_from_env
+from stats import stats_from_env
+from locks import KeyedLocks
+from scheduler import PhaseScheduler
+from shard import HashRing, game_key
+from metrics import Registry, MeteredRequest, MetricsHandler, Histogram, gauge
+from telegram.request import HTTPXRequest
+import tornado.web
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("werewolf-bot")
@@ -17,96 +32,374 @@ BOT_TOKEN = ( os.getenv("BOT_TOKEN", "")          # standard
             )
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
 PORT = int(os.getenv("PORT", "10000"))
+# set by shard.py, a worker takes updates from the dispatcher on /webhook and owns the games that hash to it
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "0"))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+SHARDS = HashRing(range(SHARD_COUNT))
 
-# thread-safe map, key is (chat_id, thread_id_or_0)
-GAMES: Dict[Tuple[int,int], Game] = {}
-HOWTO_PINNED = set()
+# thread-safe map, key is (chat_id, thread_id_or_0), kept in least recently used order
+GAMES: "OrderedDict[Tuple[int,int], Game]" = OrderedDict()
+# chat ids with the howto pinned, bounded, older entries are looked up in the store again
+HOWTO_PINNED: "OrderedDict[int, None]" = OrderedDict()
+# idle eviction, games untouched for GAME_TTL seconds or past MAX_GAMES (least recent first) leave memory
+GAME_TTL = float(os.getenv("GAME_TTL", "21600"))
+MAX_GAMES = int(os.getenv("MAX_GAMES", "20000"))
+MAX_PINNED = int(os.getenv("MAX_PINNED", "50000"))
+SWEEP_INTERVAL = float(os.getenv("SWEEP_INTERVAL", "60"))
+# write-behind persistence, handlers call STORE.touch(g) after mutating a game
+STORE = GameStore(backend_from_env(), float(os.getenv("STORE_FLUSH_INTERVAL", "2")), int(os.getenv("STORE_MAX_MISSES", "50000")))
+# OUT_GLOBAL_RATE is the bot token's msg/s, shard workers send on one token and split it
+OUT = OutboundQueue(global_rate=float(os.getenv("OUT_GLOBAL_RATE", str(GLOBAL_RATE))) / SHARD_COUNT)
+# every game's state-changing calls, appended to EVENT_LOG so any game can be replayed, empty turns it off.
+# shard workers each keep their own file
+EVENT_LOG = os.getenv("EVENT_LOG", "events.log")
+EVENTS = replay.EventLog(f"{EVENT_LOG}.{SHARD_INDEX}" if EVENT_LOG and SHARD_COUNT > 1 else EVENT_LOG,
+                         int(os.getenv("EVENT_LOG_MAX_BYTES", str(64 << 20))), int(os.getenv("EVENT_LOG_BACKUPS", "5")))
+# finished games and running totals for /stats and /leaderboard, written behind like STORE
+STATS = stats_from_env()
+# handler and Bot API latency, served as Prometheus text on /metrics
+METRICS = Registry()
+# per-game locks, handlers that mutate a Game run one at a time per game key
+LOCKS = KeyedLocks()
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "256"))
+# rendered keyboards, key is (game key, action, phase epoch, roster version)
+KEYBOARDS = GameLRU(int(os.getenv("KEYBOARD_CACHE_SIZE", "2048")))
+# phase deadlines for every game on one heap, 0 seconds turns the timer off
+DAY_SECONDS = float(os.getenv("DAY_SECONDS", "300"))
+NIGHT_SECONDS = float(os.getenv("NIGHT_SECONDS", "90"))
+# once the last vote or night action is in the phase closes after this many seconds, negative keeps the full timer
+EARLY_CLOSE_GRACE = float(os.getenv("EARLY_CLOSE_GRACE", "3"))
+TIMERS = PhaseScheduler(on_due=None)
+# balanced decks per (preset, players), simulated on a process pool in the background, /startgame never waits
+DECKS = DeckCache()
+# BALANCE_DECKS=0 keeps to the quick fallback decks and never simulates
+BALANCE_DECKS = os.getenv("BALANCE_DECKS", "1") == "1"
+BALANCE_MAX_PLAYERS = int(os.getenv("BALANCE_MAX_PLAYERS", "20"))
+BALANCE_POOL: Optional[ProcessPoolExecutor] = None
+BALANCING: Dict[Tuple[str,int], asyncio.Task] = {}
+# chat_id -> admin user ids, dropped on chat member updates, and the bot's own User
+ADMINS = AsyncTTLCache(float(os.getenv("ADMIN_CACHE_TTL", "300")), int(os.getenv("ADMIN_CACHE_SIZE", "20000")))
+BOT_ME = AsyncTTLCache(float(os.getenv("BOT_ME_TTL", "3600")), 1)
+# uid -> game key, filled by Game.add_player. A user who sits in more than one game
+# is routed to the game they joined last, DM buttons from older games act on that one.
+PLAYER_GAME: Dict[int, Tuple[int,int]] = {}
 
 def key_of(update: Update) -> Tuple[int,int]:
     chat_id = update.effective_chat.id
     thr = getattr(update.effective_message, "message_thread_id", None) or 0
     return (chat_id, thr)
 
+def reply(update: Update, ctx: ContextTypes.DEFAULT_TYPE, text: str, prio: int = CHAT, **kw) -> asyncio.Future:
+    # queued send to the update's chat and topic, await it only when the Message is needed
+    chat_id, thr = key_of(update)
+    return OUT.put(ctx.bot, chat_id, text, prio, message_thread_id=thr or None, **kw)
+
+def say(bot, g: Game, text: str, prio: int = PHASE, **kw) -> asyncio.Future:
+    # queued send to the game's chat and topic
+    return OUT.put(bot, g.chat_id, text, prio, message_thread_id=g.thread_id or None, **kw)
+
+def get_game(k: Tuple[int,int]):
+    g = GAMES.get(k)
+    if g is None:
+        # lazy rehydrate, a stored game comes back on the first update that needs it
+        g = STORE.load(k)
+        if g is None:
+            return None
+        g.index = PLAYER_GAME
+        if EVENTS.path:
+            # the log goes on under the same game, the replayer joins the pieces
+            g.events = []
+        for uid in g.players:
+            PLAYER_GAME.setdefault(uid, k)
+        GAMES[k] = g
+    else:
+        GAMES.move_to_end(k)
+    g.last_active = time.time()
+    return g
+
+def unload_game(k: Tuple[int,int]):
+    # takes a game out of memory, only unlinks players still pointing at it
+    g = GAMES.pop(k, None)
+    KEYBOARDS.drop_game(k)
+    if not g:
+        return None
+    EVENTS.take(g)
+    for uid in g.players:
+        if PLAYER_GAME.get(uid) == k:
+            del PLAYER_GAME[uid]
+    return g
+
+def drop_game(k: Tuple[int,int]):
+    # teardown, the game is gone for good
+    STORE.forget(k)
+    TIMERS.cancel(k)
+    return unload_game(k)
+
+def evict_game(k: Tuple[int,int]):
+    # idle eviction, spilled to disk when the store persists, otherwise dropped
+    g = unload_game(k)
+    if g is None:
+        return
+    if STORE.backend.persistent:
+        # its deadline stays armed, firing it loads the game back
+        STORE.spill(g)
+    else:
+        STORE.forget(k)
+        TIMERS.cancel(k)
+
+def sweep(now=None) -> int:
+    # evicts from the least recently used end, stops at the first game that is fresh and under the cap
+    now = now or time.time()
+    evicted = busy = 0
+    while len(GAMES) > busy:
+        k, g = next(iter(GAMES.items()))
+        if len(GAMES) <= MAX_GAMES and now - g.last_active < GAME_TTL:
+            break
+        if k in LOCKS.locks:
+            # a handler is running on it, look again next sweep
+            GAMES.move_to_end(k); busy += 1
+            continue
+        evict_game(k); evicted += 1
+    while len(HOWTO_PINNED) > MAX_PINNED:
+        HOWTO_PINNED.popitem(last=False)
+    return evicted
+
+async def flush_events():
+    # new log entries of every game in memory, unloaded games handed theirs over already
+    for g in GAMES.values():
+        EVENTS.take(g)
+    lines, EVENTS.pending = EVENTS.pending, []
+    if not lines:
+        return
+    try:
+        await asyncio.to_thread(EVENTS.write, lines)
+    except OSError:
+        log.exception("event log write failed, %d lines kept", len(lines))
+        EVENTS.pending[:0] = lines
+
+async def event_writer():
+    while True:
+        await asyncio.sleep(STORE.interval)
+        await flush_events()
+
+async def sweeper():
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        n = sweep()
+        if n: log.info("evicted %d idle games, %d in memory", n, len(GAMES))
+        st = OUT.stats()
+        if st["depth"]:
+            log.info("outbound queue %d deep over %d chats, wait p99 prompt %.2fs phase %.2fs chat %.2fs",
+                     st["depth"], st["chats"], st["wait_prompt_p99"], st["wait_phase_p99"], st["wait_chat_p99"])
+
+def game_of_user(uid: int):
+    k = PLAYER_GAME.get(uid) or STORE.key_for_user(uid)
+    g = get_game(k) if k else None
+    if g and uid in g.players:
+        return g
+    return None
+
+async def is_admin(bot, chat_id: int, uid: int) -> bool:
+    # one getChatAdministrators per chat per TTL, concurrent checks share the call
+    async def fetch():
+        try:
+            return frozenset(m.user.id for m in await bot.get_chat_administrators(chat_id))
+        except (BadRequest, Forbidden):
+            # private chats and chats the bot cannot see have no admins. Timeouts and flood control
+            # propagate instead, an empty list cached for the whole TTL would lock every admin out
+            return frozenset()
+    return uid in await ADMINS.get(chat_id, fetch)
+
+async def bot_username(bot) -> str:
+    return (await BOT_ME.get("me", bot.get_me)).username
+
+async def on_member_update(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    ADMINS.invalidate(update.effective_chat.id)
+
+def dm_key(update: Update):
+    # DM callbacks lock the game the button names, or else the one the presser sits in
+    k = button_game(update.callback_query.data or "")
+    if k:
+        return k
+    uid = update.effective_user.id
+    g = game_of_user(uid)
+    return g.key if g else ("dm", uid)
+
+def serialized(fn, key_fn=key_of):
+    # wraps a handler so updates for one game never interleave, other games run concurrently
+    @functools.wraps(fn)
+    async def wrapper(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+        async with LOCKS.hold(key_fn(update)):
+            return await fn(update, ctx)
+    return wrapper
+
 async def pin_howto_once(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     if chat_id in HOWTO_PINNED:
+        HOWTO_PINNED.move_to_end(chat_id)
+        return
+    if STORE.is_pinned(chat_id):
+        HOWTO_PINNED[chat_id] = None
         return
-    msg = await update.effective_message.reply_text(
+    msg = await reply(update, ctx,
         "🐺 Werewolf, cara main, host, /newgame, semua /join, host /startgame. Day, vote, Night, actions DM. Enjoy."
     )
     try:
-        await ctx.bot.pin_chat_message(chat_id=chat_id, message_id=msg.message_id)
+        if msg: await ctx.bot.pin_chat_message(chat_id=chat_id, message_id=msg.message_id)
     except Exception:
         pass
-    HOWTO_PINNED.add(chat_id)
+    HOWTO_PINNED[chat_id] = None
+    STORE.pin(chat_id)
 
 async def cmd_newgame(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     k = key_of(update)
-    GAMES.pop(k, None)
-    g = Game(chat_id=k[0], thread_id=k[1])
+    drop_game(k)
+    # ms clock, differs from the last game in this chat, keeps its buttons from landing here
+    # the seed stays server side, gid is in every button and must not give the deal away
+    g = Game(chat_id=k[0], thread_id=k[1], index=PLAYER_GAME, gid=int(time.time() * 1000) & 0xffffffff,
+             seed=secrets.randbits(64))
+    if EVENTS.path:
+        replay.start(g)
     g.host_id = update.effective_user.id
     g.phase = "lobby"
+    g.last_active = time.time()
     GAMES[k] = g
+    STORE.touch(g)
     await pin_howto_once(update, ctx)
-    await update.effective_message.reply_text(
-        f"New Werewolf lobby created. Host @{update.effective_user.username or update.effective_user.first_name}. Players /join. Host /startgame."
-    )
+    reply(update, ctx, f"New Werewolf lobby created. Host @{update.effective_user.username or update.effective_user.first_name}. Players /join. Host /startgame.")
 
 async def cmd_join(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     k = key_of(update)
-    g = GAMES.get(k)
+    g = get_game(k)
     if not g or g.phase != "lobby":
-        await update.effective_message.reply_text("No active lobby. Use /newgame first.")
+        reply(update, ctx, "No active lobby. Use /newgame first.")
         return
     uid = update.effective_user.id
     if uid in g.players:
-        await update.effective_message.reply_text("You are already in the lobby.")
+        reply(update, ctx, "You are already in the lobby.")
         return
     g.add_player(uid, update.effective_user.full_name)
-    await update.effective_message.reply_text(f"{update.effective_user.full_name} joined the lobby.")
+    STORE.touch(g)
+    reply(update, ctx, f"{update.effective_user.full_name} joined the lobby.")
 
 async def cmd_status(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    k = key_of(update); g = GAMES.get(k)
+    k = key_of(update); g = get_game(k)
     if not g:
-        await update.effective_message.reply_text("No game here.")
+        reply(update, ctx, "No game here.")
+        return
+    reply(update, ctx, f"Phase, {g.phase}, day, {g.day}, players, {len(g.players)}")
+
+def pct(a: int, b: int) -> str:
+    return f"{100 * a / b:.0f}%" if b else "-"
+
+async def cmd_stats(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    # the caller's totals, or the replied-to player's, plus this chat's when asked in a group
+    msg = update.effective_message
+    user = msg.reply_to_message.from_user if msg.reply_to_message and msg.reply_to_message.from_user else update.effective_user
+    st = STATS.user(user.id)
+    if not st:
+        reply(update, ctx, f"{user.first_name} belum habis main satu game pun.")
+        return
+    lines = [f"📊 {st['name']}, {st['games']} game, menang {st['wins']} ({pct(st['wins'], st['games'])}), "
+             f"hidup {pct(st['survived'], st['games'])}, digantung {st['lynched']}"]
+    roles = STATS.user_roles(user.id)[:5]
+    if roles:
+        lines.append("Role, " + ", ".join(f"{r} {w}/{n}" for r, n, w in roles))
+    if update.effective_chat.type != "private":
+        cu = STATS.chat_user(update.effective_chat.id, user.id)
+        ch = STATS.chat(update.effective_chat.id)
+        if cu:
+            lines.append(f"Di sini, {cu['games']} game, menang {cu['wins']}, hidup {pct(cu['survived'], cu['games'])}")
+        if ch:
+            wins = ", ".join(f"{t} {n}" for t, n in sorted(ch["wins"].items(), key=lambda x: -x[1]))
+            lines.append(f"Chat ini, {ch['games']} game, hidup {pct(ch['survived'], ch['seats'])}, menang {wins}")
+    reply(update, ctx, "\n".join(lines))
+
+async def cmd_leaderboard(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    # this chat's board in a group, the global one in DM
+    chat = update.effective_chat
+    rows = STATS.leaderboard(None if chat.type == "private" else chat.id, 10)
+    if not rows:
+        reply(update, ctx, "Belum ada game yang tamat.")
         return
-    await update.effective_message.reply_text(f"Phase, {g.phase}, day, {g.day}, players, {len(g.players)}")
+    title = "🏆 Leaderboard" if chat.type == "private" else "🏆 Leaderboard chat ini"
+    reply(update, ctx, title + "\n" + "\n".join(
+        f"{i}. {name}, menang {wins}/{games}, hidup {pct(survived, games)}"
+        for i, (_, name, games, wins, survived) in enumerate(rows, 1)))
 
 async def dm_roles_or_panel(update: Update, ctx: ContextTypes.DEFAULT_TYPE, g: Game):
-    me = await ctx.bot.get_me()
-    missing=[]
-    for uid, ps in g.players.items():
-        try:
-            await ctx.bot.send_message(chat_id=uid, text=f"🎭 Role kau, {ps.role.name}.")
-        except Exception:
-            missing.append(uid)
+    missing = await OUT.send_many(ctx.bot, [(uid, f"🎭 Role kau, {ps.role.name}.", {}) for uid, ps in g.players.items()])
     if missing:
-        btn = InlineKeyboardMarkup([[InlineKeyboardButton("🔒 Open DM to receive your role", url=f"https://t.me/{me.username}?start=role_{g.chat_id}_{g.thread_id}")]])
-        await update.effective_message.reply_text("Ada pemain belum buka DM bot. Tap butang ini, tekan Start. Host boleh /resendroles.", reply_markup=btn)
+        btn = InlineKeyboardMarkup([[InlineKeyboardButton("🔒 Open DM to receive your role", url=f"https://t.me/{await bot_username(ctx.bot)}?start=role_{g.chat_id}_{g.thread_id}")]])
+        reply(update, ctx, "Ada pemain belum buka DM bot. Tap butang ini, tekan Start. Host boleh /resendroles.", reply_markup=btn)
+
+async def cmd_preset(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    k = key_of(update); g = get_game(k)
+    if not g or g.phase != "lobby":
+        reply(update, ctx, "No active lobby. Use /newgame first.")
+        return
+    args = (update.effective_message.text or "").split()[1:]
+    if not args or args[0] not in DECKS.presets:
+        reply(update, ctx, f"Preset, {g.preset}. Pilihan, {', '.join(DECKS.presets)}.")
+        return
+    g.preset = args[0]
+    STORE.touch(g)
+    ensure_deck(g.preset, len(g.players))
+    reply(update, ctx, f"Preset {g.preset}.")
+
+def ensure_deck(preset: str, n: int):
+    # start simulating the deck for (preset, n) unless it is cached or already running
+    k = (preset, n)
+    if not BALANCE_DECKS or n < MIN_PLAYERS or DECKS.get(preset, n) or k in BALANCING:
+        return
+    BALANCING[k] = asyncio.create_task(_balance(preset, n))
+
+async def _balance(preset: str, n: int):
+    global BALANCE_POOL
+    try:
+        if BALANCE_POOL is None:
+            # forkserver, forking this process would copy its sqlite and to_thread threads mid-write and its open sockets
+            BALANCE_POOL = ProcessPoolExecutor(mp_context=multiprocessing.get_context("forkserver"))
+        c = await asyncio.to_thread(DECKS.build, BALANCE_POOL, preset, n)
+        await asyncio.to_thread(DECKS.save)
+        log.info("deck %s/%d balanced, %d wolves, village wins %.0f%%", preset, n, c.wolves, c.village_rate * 100)
+    except Exception:
+        log.exception("deck balancing for %s/%d failed", preset, n)
+    finally:
+        BALANCING.pop((preset, n), None)
+
+async def warm_decks():
+    # one deck at a time, the pool already spreads each deck's games over every core
+    for preset in DECKS.presets:
+        for n in range(MIN_PLAYERS, BALANCE_MAX_PLAYERS + 1):
+            ensure_deck(preset, n)
+            t = BALANCING.get((preset, n))
+            if t: await t
 
 async def cmd_startgame(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    k = key_of(update); g = GAMES.get(k)
+    k = key_of(update); g = get_game(k)
     if not g or g.phase != "lobby":
-        await update.effective_message.reply_text("No active lobby. Use /newgame first.")
+        reply(update, ctx, "No active lobby. Use /newgame first.")
         return
     # host or admin
-    if update.effective_user.id != g.host_id:
-        m = await ctx.bot.get_chat_member(update.effective_chat.id, update.effective_user.id)
-        if m.status not in ("administrator","creator"):
-            await update.effective_message.reply_text("Only the host can start the game.")
-            return
+    if update.effective_user.id != g.host_id and not await is_admin(ctx.bot, update.effective_chat.id, update.effective_user.id):
+        reply(update, ctx, "Only the host can start the game.")
+        return
     if len(g.players) < MIN_PLAYERS:
-        await update.effective_message.reply_text(f"Need at least {MIN_PLAYERS} players to start.")
+        reply(update, ctx, f"Need at least {MIN_PLAYERS} players to start.")
         return
-    g.assign_roles(ALL_ROLES)
+    g.assign_roles(DECKS.deck_for(g.preset, len(g.players)))
+    ensure_deck(g.preset, len(g.players))
+    arm_deadline(g)
+    STORE.touch(g)
     await dm_roles_or_panel(update, ctx, g)
-    await update.effective_message.reply_text("🌞 Siang 1 bermula, masa borak dan undi.")
+    reply(update, ctx, "🌞 Siang 1 bermula, masa borak dan undi.", PHASE)
     await cmd_votebuttons(update, ctx)
 
 async def cmd_resendroles(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    k = key_of(update); g = GAMES.get(k)
+    k = key_of(update); g = get_game(k)
     if not g:
-        await update.effective_message.reply_text("No active game here.")
+        reply(update, ctx, "No active game here.")
         return
     await dm_roles_or_panel(update, ctx, g)
 
@@ -118,209 +411,490 @@ async def cmd_start_private(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         try:
             _, chat_id_str, thread_id_str = payload.split("_", 2)
             k=(int(chat_id_str), int(thread_id_str))
-            g=GAMES.get(k)
+            g=get_game(k)
             if not g:
-                await update.effective_message.reply_text("No active game for that chat.")
+                reply(update, ctx, "No active game for that chat.")
                 return
             uid = update.effective_user.id
             if uid not in g.players:
-                await update.effective_message.reply_text("Join lobby dalam group dulu.")
+                reply(update, ctx, "Join lobby dalam group dulu.")
                 return
-            await update.effective_message.reply_text(f"🎭 Role kau, {g.players[uid].role.name}.")
+            reply(update, ctx, f"🎭 Role kau, {g.players[uid].role.name}.", PROMPT)
         except Exception:
-            await update.effective_message.reply_text("Hi, tekan Start. Role dihantar bila host mula game.")
+            reply(update, ctx, "Hi, tekan Start. Role dihantar bila host mula game.")
     else:
-        await update.effective_message.reply_text("Hi, tekan Start. Role dihantar bila host mula game.")
+        reply(update, ctx, "Hi, tekan Start. Role dihantar bila host mula game.")
 
 # --- Voting ---
-async def post_vote_keyboard(update: Update, ctx: ContextTypes.DEFAULT_TYPE, g: Game):
+# votes landing within this window are folded into one edit of the vote message
+VOTE_PANEL_DELAY = float(os.getenv("VOTE_PANEL_DELAY", "2"))
+PANEL_PENDING: Dict[Tuple[int,int], asyncio.Task] = {}
+
+# --- Buttons ---
+# callback_data is "<letter>:<gid>:<epoch>:<seat>", gid and epoch in hex, seat 0 is skip, or pass on a potion, e.g. "k:18c2a9f:3:7".
+# Night buttons live in DMs and add the game's chat and thread in hex, "k:18c2a9f:3:7:-3b9aca07:0", so the press
+# finds its game, and its shard, without the player index. Well under the 64 byte limit, and a press from an
+# older game or phase is turned away before any game state is read
+BUTTON_CODES = {"vote": "v", "kill": "k", "peek": "p", "aura": "a", "save": "s", "protect": "g", "heal": "h",
+                "poison": "x", "bless": "b", "scry": "y", "bite": "i", "recruit": "r"}
+BUTTON_ACTIONS = {c: a for a, c in BUTTON_CODES.items()}
+NIGHT_BUTTONS = "".join(c for a, c in BUTTON_CODES.items() if a in NIGHT_ACTIONS)
+
+def button_data(g: Game, action: str, seat: int) -> str:
+    data = f"{BUTTON_CODES[action]}:{g.gid:x}:{g.epoch:x}:{seat}"
+    if action != "vote":
+        data += f":{g.chat_id:x}:{g.thread_id:x}"
+    return data
+
+def button_game(data: str) -> Optional[Tuple[int,int]]:
+    # the game key a night button carries, None for vote buttons and older night buttons
+    parts = data.split(":")
+    if len(parts) != 6:
+        return None
+    try:
+        return (int(parts[4], 16), int(parts[5], 16))
+    except ValueError:
+        return None
+
+def parse_button(data: str, g: Optional[Game]):
+    # (action, seat) for a press on this game's current keyboards, None for anything stale or malformed
+    try:
+        code, gid, epoch, seat = data.split(":")[:4]
+        if g is None or int(epoch, 16) != g.epoch or int(gid, 16) != g.gid:
+            return None
+        return BUTTON_ACTIONS[code], int(seat)
+    except (ValueError, KeyError):
+        return None
+
+async def stale_button(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    # presses on keyboards from an older layout, answered so the client stops spinning
+    await update.callback_query.answer("⌛ Butang ini sudah tamat.")
+
+def vote_keyboard(g: Game):
+    return KEYBOARDS.get((g.key, "vote", g.epoch, g.roster_version), lambda: _build_vote_keyboard(g))
+
+def _build_vote_keyboard(g: Game):
     rows=[]
     alive = g.alive_list()
     num_map = g.list_alive_numbers()
     for uid in alive:
         label = f"{num_map[uid]}. {g.players[uid].name}"
-        rows.append([InlineKeyboardButton(label, callback_data=f"vote:{uid}")])
-    rows.append([InlineKeyboardButton("⏭ Skip", callback_data="vote:skip")])
-    kb=InlineKeyboardMarkup(rows)
-    msg = await ctx.bot.send_message(chat_id=g.chat_id, text="🗳 Vote sekarang", reply_markup=kb, message_thread_id=g.thread_id or None)
-    g.vote_msg_id = msg.message_id
+        rows.append([InlineKeyboardButton(label, callback_data=button_data(g, "vote", num_map[uid]))])
+    rows.append([InlineKeyboardButton("⏭ Skip", callback_data=button_data(g, "vote", 0))])
+    return InlineKeyboardMarkup(rows)
+
+def vote_panel_text(g: Game) -> str:
+    if not g.votes:
+        return "🗳 Vote sekarang"
+    lines=["🗳 Vote sekarang", ""]
+    for tgt,n in sorted(g.vote_counts().items(), key=lambda kv: -kv[1]):
+        name = "Skip" if tgt=="skip" else g.players[tgt].name
+        lines.append(f"{n} × {name}")
+    voted=", ".join(g.players[v].name for v in g.votes)
+    lines.append(f"\n✅ Sudah undi ({len(g.votes)}/{len(g.alive_list())}), {voted}")
+    return "\n".join(lines)
+
+async def post_vote_keyboard(update: Update, ctx: ContextTypes.DEFAULT_TYPE, g: Game):
+    send_vote_keyboard(ctx.bot, g)
+
+def send_vote_keyboard(bot, g: Game) -> asyncio.Future:
+    # queued, not awaited, callers hold the game lock and a group send can wait seconds for its bucket.
+    # the message id is kept once it is sent, if the game is still in the same phase
+    fut = say(bot, g, vote_panel_text(g), reply_markup=vote_keyboard(g))
+    epoch = g.epoch
+    def sent(f: asyncio.Future):
+        msg = None if f.cancelled() or f.exception() else f.result()
+        if msg and g.epoch == epoch and GAMES.get(g.key) is g:
+            g.vote_msg_id = msg.message_id
+            STORE.touch(g)
+    fut.add_done_callback(sent)
+    return fut
+
+async def _flush_vote_panel(bot, g: Game):
+    try:
+        await asyncio.sleep(VOTE_PANEL_DELAY)
+    finally:
+        PANEL_PENDING.pop(g.key, None)
+    if g.phase!="day" or not g.vote_msg_id:
+        return
+    # through the outbound queue, the edit takes a token from the group's bucket and waits out flood control
+    OUT.edit(bot, g.chat_id, g.vote_msg_id, vote_panel_text(g), reply_markup=vote_keyboard(g))
+
+def schedule_vote_panel(bot, g: Game):
+    # leading vote opens the window, the rest ride along on the same edit
+    if g.key not in PANEL_PENDING:
+        PANEL_PENDING[g.key] = asyncio.create_task(_flush_vote_panel(bot, g))
 
 async def cmd_votebuttons(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    k=key_of(update); g=GAMES.get(k)
+    k=key_of(update); g=get_game(k)
     if not g or g.phase!="day":
-        await update.effective_message.reply_text("No active day here.")
+        reply(update, ctx, "No active day here.")
         return
     await post_vote_keyboard(update, ctx, g)
 
 async def handle_vote(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    q=update.callback_query; await q.answer()
-    k=key_of(update); g=GAMES.get(k)
-    if not g or g.phase!="day": return
+    q=update.callback_query
+    k=key_of(update); g=get_game(k)
+    btn=parse_button(q.data, g)
+    if not btn:
+        await q.answer("⌛ Butang ini sudah tamat.")
+        return
+    await q.answer()
+    if g.phase!="day": return
     voter=q.from_user.id
-    if voter not in g.players or not g.players[voter].alive: return
-    data=q.data.split(":")[1]
-    target = data if data=="skip" else int(data)
+    if not g.is_alive(voter): return
+    target = "skip" if btn[1]==0 else g.at_seat(btn[1])
+    if target is None: return
     msg = g.vote(voter, target)
-    await ctx.bot.send_message(chat_id=g.chat_id, text=f"✅ {g.players[voter].name} voted.", message_thread_id=g.thread_id or None)
+    close_early(g)
+    STORE.touch(g)
+    schedule_vote_panel(ctx.bot, g)
 
 async def cmd_tally(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    k=key_of(update); g=GAMES.get(k)
+    k=key_of(update); g=get_game(k)
     if not g or g.phase!="day":
-        await update.effective_message.reply_text("No active day here.")
+        reply(update, ctx, "No active day here.")
         return
     target, tie = g.tally()
     if tie or not target:
-        await update.effective_message.reply_text("🧮 Kiraan undi, tiada majoriti.")
+        reply(update, ctx, "🧮 Kiraan undi, tiada majoriti.")
     else:
-        await update.effective_message.reply_text(f"🧮 Kiraan undi, paling banyak, {g.players[target].name}.")
+        reply(update, ctx, f"🧮 Kiraan undi, paling banyak, {g.players[target].name}.")
 
 async def cmd_nextphase(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    k=key_of(update); g=GAMES.get(k)
+    k=key_of(update); g=get_game(k)
     if not g:
-        await update.effective_message.reply_text("No active game here.")
+        reply(update, ctx, "No active game here.")
         return
     # host or admin only
-    if update.effective_user.id != g.host_id:
-        m = await ctx.bot.get_chat_member(update.effective_chat.id, update.effective_user.id)
-        if m.status not in ("administrator","creator"):
-            await update.effective_message.reply_text("Only the host can change phase.")
-            return
-    if g.phase=="day":
-        text = g.resolve_day()
-        await update.effective_message.reply_text(text)
-    elif g.phase=="night":
-        text = g.resolve_night()
-        await update.effective_message.reply_text(text)
-    else:
-        await update.effective_message.reply_text("Not in a running game.")
+    if update.effective_user.id != g.host_id and not await is_admin(ctx.bot, update.effective_chat.id, update.effective_user.id):
+        reply(update, ctx, "Only the host can change phase.")
+        return
+    if not await advance_phase(ctx.bot, g):
+        reply(update, ctx, "Not in a running game.")
 
 async def cmd_claimhost(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    k=key_of(update); g=GAMES.get(k)
+    k=key_of(update); g=get_game(k)
     if not g or g.phase!="lobby":
-        await update.effective_message.reply_text("No game lobby found.")
+        reply(update, ctx, "No game lobby found.")
         return
-    m = await ctx.bot.get_chat_member(update.effective_chat.id, update.effective_user.id)
-    if update.effective_user.id not in g.players and m.status not in ("administrator","creator"):
-        await update.effective_message.reply_text("Join the lobby first or be an admin.")
+    if update.effective_user.id not in g.players and not await is_admin(ctx.bot, update.effective_chat.id, update.effective_user.id):
+        reply(update, ctx, "Join the lobby first or be an admin.")
         return
     g.host_id = update.effective_user.id
-    await update.effective_message.reply_text(f"You are now the host, {update.effective_user.first_name}.")
+    STORE.touch(g)
+    reply(update, ctx, f"You are now the host, {update.effective_user.first_name}.")
 
 # Night action buttons in DM (basic mapping)
 async def handle_action_button(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    q=update.callback_query; await q.answer()
-    data=q.data; klist=[]
-    try:
-        action, target = data.split(":")
-        target = int(target)
-    except:
-        return
-    # find the game where this user exists
-    game=None
-    for key,g in GAMES.items():
-        if q.from_user.id in g.players: game=g; break
-    if not game or game.phase!="night":
+    q=update.callback_query
+    k=button_game(q.data)
+    game=get_game(k) if k else game_of_user(q.from_user.id)
+    if game and q.from_user.id not in game.players:
+        game=None
+    btn=parse_button(q.data, game)
+    if not btn:
+        await q.answer("⌛ Butang ini sudah tamat.")
+        return
+    await q.answer()
+    action, target = btn[0], game.at_seat(btn[1])
+    if btn[1] == 0 and action in PASSABLE and game.phase == "night":
+        res = game.act(action, q.from_user.id, None)
+        close_early(game)
+        STORE.touch(game)
+        await q.edit_message_text(res)
+        return
+    if game.phase!="night" or target is None:
         await q.edit_message_text("Action only at night, in DM.")
         return
-    mapping={
-        "kill":"wolf_kill","peek":"seer_peek","aura":"aura_peek","save":"doctor_save","protect":"bodyguard_protect",
-        "heal":"witch_heal","poison":"witch_poison","bless":"priest_bless","scry":"sorceress_scry","bite":"vampire_bite","recruit":"cult_recruit"
-    }
-    meth=mapping.get(action)
-    if not meth or not hasattr(game, meth):
+    if action not in NIGHT_ACTIONS:
         await q.edit_message_text("Action not supported here.")
         return
-    res=getattr(game, meth)(q.from_user.id, target)
+    res=game.act(action, q.from_user.id, target)
+    close_early(game)
+    STORE.touch(game)
     await q.edit_message_text(res)
 
 # Minimal target keyboard for DM
 def targets_keyboard(g: Game, action: str):
+    return KEYBOARDS.get((g.key, action, g.epoch, g.roster_version), lambda: _build_targets_keyboard(g, action))
+
+def _build_targets_keyboard(g: Game, action: str):
     alive=g.alive_list()
-    rows=[[InlineKeyboardButton(g.players[uid].name, callback_data=f"{action}:{uid}")] for uid in alive]
+    seats=g.list_alive_numbers()
+    rows=[[InlineKeyboardButton(g.players[uid].name, callback_data=button_data(g, action, seats[uid]))] for uid in alive]
+    if action in PASSABLE:
+        # seat 0 passes, the witch gets a prompt per potion and the night waits for both
+        rows.append([InlineKeyboardButton("⏭ Tak guna", callback_data=button_data(g, action, 0))])
     return InlineKeyboardMarkup(rows)
 
+# night prompts with a pass button, optional actions of a role that gets more than one prompt
+PASSABLE = {"heal", "poison"}
+
+# DM text per night action code, which roles get which code lives in game.game.NIGHT_ACTIONS
+NIGHT_PROMPTS={
+    "kill":"🐺 Pilih mangsa", "peek":"🔮 Pilih target", "aura":"🌈 Aura siapa", "save":"💉 Save siapa",
+    "protect":"🛡 Protect siapa", "heal":"🧪 Heal siapa", "poison":"☠️ Poison siapa", "bless":"✨ Bless siapa",
+    "scry":"🧿 Scry siapa", "bite":"🧛 Bite siapa", "recruit":"✝ Recruit siapa",
+}
+
 # Entry points to start night DMs, you may call these when entering night
 async def dm_night_prompts(update: Update, ctx: ContextTypes.DEFAULT_TYPE, g: Game):
-    # Wolves
-    for uid in list(g.wolves):
-        try:
-            await ctx.bot.send_message(chat_id=uid, text="🐺 Pilih mangsa", reply_markup=targets_keyboard(g,"kill"))
-        except: pass
-    # Seer
-    for uid,ps in g.players.items():
-        if ps.role.name=="Seer" and ps.alive:
-            try:
-                await ctx.bot.send_message(chat_id=uid, text="🔮 Pilih target", reply_markup=targets_keyboard(g,"peek"))
-            except: pass
-    # Doctor, Bodyguard, Witch, Vampire, Cult, Priest, Sorceress, Aura
-    for uid,ps in g.players.items():
-        if ps.role.name=="Doctor" and ps.alive:
-            try: await ctx.bot.send_message(chat_id=uid, text="💉 Save siapa", reply_markup=targets_keyboard(g,"save"))
-            except: pass
-        if ps.role.name=="Bodyguard" and ps.alive:
-            try: await ctx.bot.send_message(chat_id=uid, text="🛡 Protect siapa", reply_markup=targets_keyboard(g,"protect"))
-            except: pass
-        if ps.role.name=="Witch" and ps.alive:
-            try: await ctx.bot.send_message(chat_id=uid, text="🧪 Heal siapa", reply_markup=targets_keyboard(g,"heal"))
-            except: pass
-            try: await ctx.bot.send_message(chat_id=uid, text="☠️ Poison siapa", reply_markup=targets_keyboard(g,"poison"))
-            except: pass
-        if ps.role.name=="Vampire" and ps.alive:
-            try: await ctx.bot.send_message(chat_id=uid, text="🧛 Bite siapa", reply_markup=targets_keyboard(g,"bite"))
-            except: pass
-        if ps.role.name=="Cult Leader" and ps.alive:
-            try: await ctx.bot.send_message(chat_id=uid, text="✝ Recruit siapa", reply_markup=targets_keyboard(g,"recruit"))
-            except: pass
-        if ps.role.name=="Priest" and ps.alive:
-            try: await ctx.bot.send_message(chat_id=uid, text="✨ Bless siapa", reply_markup=targets_keyboard(g,"bless"))
-            except: pass
-        if ps.role.name=="Sorceress" and ps.alive:
-            try: await ctx.bot.send_message(chat_id=uid, text="🧿 Scry siapa", reply_markup=targets_keyboard(g,"scry"))
-            except: pass
-        if ps.role.name=="Aura Seer" and ps.alive:
-            try: await ctx.bot.send_message(chat_id=uid, text="🌈 Aura siapa", reply_markup=targets_keyboard(g,"aura"))
-            except: pass
+    # waits for the sends, returns the uids that did not get every prompt
+    return await OUT.send_many(ctx.bot, night_prompt_msgs(g))
+
+def night_prompt_msgs(g: Game):
+    return [(uid, NIGHT_PROMPTS[code], {"reply_markup": targets_keyboard(g, code)}) for uid, code in g.night_actors()]
+
+def send_night_prompts(bot, g: Game):
+    # queued, not awaited, see send_vote_keyboard
+    for uid, text, kw in night_prompt_msgs(g):
+        OUT.put(bot, uid, text, PROMPT, **kw)
+
+# --- Phase changes ---
+def arm_deadline(g: Game):
+    secs = DAY_SECONDS if g.phase=="day" else NIGHT_SECONDS if g.phase=="night" else 0
+    if secs > 0:
+        g.deadline = time.time() + secs
+        TIMERS.schedule(g.key, g.deadline)
+    else:
+        g.deadline = 0.0
+        TIMERS.cancel(g.key)
+
+def close_early(g: Game):
+    # everyone is in, pull the deadline forward, the timer task resolves it after this handler lets go of the lock
+    if EARLY_CLOSE_GRACE < 0 or g.waiting_on():
+        return
+    when = time.time() + EARLY_CLOSE_GRACE
+    if g.deadline and g.deadline <= when:
+        return
+    g.deadline = when
+    TIMERS.schedule(g.key, when)
+
+def end_roster(g: Game) -> str:
+    return "\n".join(f"{'💀' if not g.players[uid].alive else '🙂'} {g.players[uid].name}, {g.players[uid].role.name}" for uid in g.order)
+
+def end_game(g: Game):
+    # a decided game leaves memory and the store at once, its buttons go stale with it
+    task = PANEL_PENDING.pop(g.key, None)
+    if task: task.cancel()
+    STATS.record(g)
+    drop_game(g.key)
+    log.info("game %s over, %s won on day %d", g.key, g.winner, g.day)
+
+async def advance_phase(bot, g: Game) -> bool:
+    # resolves the running day or night, announces it and opens the next phase, False when not running
+    if g.phase not in ("day", "night"):
+        return False
+    if g.phase=="day":
+        text = g.resolve_day()
+    else:
+        text = g.resolve_night()
+    if g.phase=="end":
+        say(bot, g, text + "\n\n" + end_roster(g))
+        end_game(g)
+        return True
+    arm_deadline(g)
+    STORE.touch(g)
+    say(bot, g, text)
+    # everything is queued, the lock is let go before any of it is sent
+    if g.phase=="night":
+        send_night_prompts(bot, g)
+    elif g.phase=="day":
+        send_vote_keyboard(bot, g)
+    return True
+
+async def on_deadline(bot, k: Tuple[int,int]):
+    async with LOCKS.hold(k):
+        g = get_game(k)
+        if not g or not g.deadline:
+            return
+        if g.deadline > time.time():
+            # moved while this entry waited, the newer one is already queued
+            return
+        log.info("phase deadline reached for %s, %s %d", k, g.phase, g.day)
+        await advance_phase(bot, g)
 
 async def cmd_nextnight(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     # convenience, end day and start night prompts
-    k=key_of(update); g=GAMES.get(k)
+    k=key_of(update); g=get_game(k)
     if not g: 
-        await update.effective_message.reply_text("No game here.")
+        reply(update, ctx, "No game here.")
         return
     if g.phase!="day":
-        await update.effective_message.reply_text("Not in day.")
+        reply(update, ctx, "Not in day.")
         return
-    await update.effective_message.reply_text(g.resolve_day())
-    await dm_night_prompts(update, ctx, g)
+    await advance_phase(ctx.bot, g)
 
 async def cmd_nextday(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    k=key_of(update); g=GAMES.get(k)
+    k=key_of(update); g=get_game(k)
     if not g: 
-        await update.effective_message.reply_text("No game here.")
+        reply(update, ctx, "No game here.")
         return
     if g.phase!="night":
-        await update.effective_message.reply_text("Not in night.")
+        reply(update, ctx, "Not in night.")
         return
-    await update.effective_message.reply_text(g.resolve_night())
-    await cmd_votebuttons(update, ctx)
+    await advance_phase(ctx.bot, g)
+
+def owns(k: Tuple[int,int]) -> bool:
+    # with a shared GAME_DB every worker sees every deadline, only the owner arms it
+    return SHARD_COUNT == 1 or SHARDS.node_for(game_key(*k)) == SHARD_INDEX
+
+async def on_startup(app):
+    STORE.start()
+    STATS.start()
+    if EVENTS.path:
+        app.bot_data["events"] = asyncio.create_task(event_writer())
+    app.bot_data["sweeper"] = asyncio.create_task(sweeper())
+    # deadlines stored before a restart, overdue ones fire right away and load their game
+    TIMERS.on_due = functools.partial(on_deadline, app.bot)
+    for k, dl in STORE.backend.load_deadlines():
+        if k not in TIMERS.deadlines and owns(k):
+            TIMERS.schedule(k, dl)
+    TIMERS.start()
+    if BALANCE_DECKS and SHARD_INDEX == 0:
+        # one shard fills the cache, every worker would otherwise simulate the same decks on its own pool
+        app.bot_data["decks"] = asyncio.create_task(warm_decks())
 
-def build_app():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+async def on_shutdown(app):
+    task = app.bot_data.pop("sweeper", None)
+    if task: task.cancel()
+    TIMERS.stop()
+    task = app.bot_data.pop("decks", None)
+    if task: task.cancel()
+    if BALANCE_POOL: BALANCE_POOL.shutdown(wait=False, cancel_futures=True)
+    await OUT.drain()
+    await STORE.stop()
+    await STATS.stop()
+    task = app.bot_data.pop("events", None)
+    if task:
+        task.cancel()
+        await flush_events()
+
+def build_app(request=None):
+    # updates run concurrently across games, serialized() keeps each game's mutations in order
+    builder = (ApplicationBuilder().token(BOT_TOKEN).concurrent_updates(CONCURRENT_UPDATES)
+               .post_init(on_startup).post_shutdown(on_shutdown))
+    # every Bot API call is timed by method, request is an alternate transport, the load generator passes its local fake here
+    builder = (builder.request(MeteredRequest(request or HTTPXRequest(connection_pool_size=256), METRICS))
+               .get_updates_request(MeteredRequest(request or HTTPXRequest(), METRICS)))
+    app = builder.build()
     # commands
-    app.add_handler(CommandHandler("newgame", cmd_newgame))
-    app.add_handler(CommandHandler("join", cmd_join))
+    app.add_handler(CommandHandler("newgame", serialized(cmd_newgame)))
+    app.add_handler(CommandHandler("join", serialized(cmd_join)))
     app.add_handler(CommandHandler("status", cmd_status))
-    app.add_handler(CommandHandler("startgame", cmd_startgame))
+    app.add_handler(CommandHandler("stats", cmd_stats))
+    app.add_handler(CommandHandler("leaderboard", cmd_leaderboard))
+    app.add_handler(CommandHandler("preset", serialized(cmd_preset)))
+    app.add_handler(CommandHandler("startgame", serialized(cmd_startgame)))
     app.add_handler(CommandHandler("resendroles", cmd_resendroles))
-    app.add_handler(CommandHandler("nextphase", cmd_nextphase))
-    app.add_handler(CommandHandler("night2day", cmd_nextday))
-    app.add_handler(CommandHandler("votebuttons", cmd_votebuttons))
+    app.add_handler(CommandHandler("nextphase", serialized(cmd_nextphase)))
+    app.add_handler(CommandHandler("night2day", serialized(cmd_nextday)))
+    app.add_handler(CommandHandler("votebuttons", serialized(cmd_votebuttons)))
     app.add_handler(CommandHandler("start", cmd_start_private, filters.ChatType.PRIVATE))
+    # admin list changes, needs chat_member in allowed_updates
+    app.add_handler(ChatMemberHandler(on_member_update, ChatMemberHandler.ANY_CHAT_MEMBER))
     # callbacks
-    app.add_handler(CallbackQueryHandler(handle_vote, pattern=r"^vote:(.+)$"))
-    app.add_handler(CallbackQueryHandler(handle_action_button, pattern=r"^(kill|peek|aura|save|protect|heal|poison|bless|scry|bite|recruit):\d+$"))
+    app.add_handler(CallbackQueryHandler(serialized(handle_vote), pattern=r"^v:[0-9a-f]+:[0-9a-f]+:\d+$"))
+    app.add_handler(CallbackQueryHandler(serialized(handle_action_button, dm_key), pattern=rf"^[{NIGHT_BUTTONS}]:[0-9a-f]+:[0-9a-f]+:\d+(:-?[0-9a-f]+:[0-9a-f]+)?$"))
+    app.add_handler(CallbackQueryHandler(stale_button))
+    # time every handler from the outside, lock waits count
+    for group in app.handlers.values():
+        for h in group:
+            h.callback = METRICS.instrument(h.callback.__name__, h.callback)
     return app
 
+PLAYER_BUCKETS = (4, 6, 8, 10, 12, 16, 20, 30, 50)
+
+def collect_gauges():
+    # read on scrape, one pass over the games in memory
+    phases: Dict[str,int] = {}
+    players = Histogram(PLAYER_BUCKETS)
+    for g in GAMES.values():
+        phases[g.phase] = phases.get(g.phase, 0) + 1
+        players.observe(len(g.players))
+    out = gauge("werewolf_games", "Games in memory by phase.", [({"phase": p}, n) for p, n in sorted(phases.items())])
+    out += ["# HELP werewolf_players_per_game Players per game in memory.", "# TYPE werewolf_players_per_game histogram"]
+    out.extend(players.lines("werewolf_players_per_game", ""))
+    st = OUT.stats()
+    out += gauge("werewolf_outbound_depth", "Queued outbound messages by priority class.",
+                 [({"prio": p}, st[f"depth_{p}"]) for p in ("prompt", "phase", "chat")])
+    out += gauge("werewolf_outbound_wait_seconds", "Recent outbound queue wait by priority class.",
+                 [({"prio": p, "quantile": q}, st[f"wait_{p}_{k}"])
+                  for p in ("prompt", "phase", "chat") for q, k in (("0.5", "p50"), ("0.99", "p99"))])
+    out += gauge("werewolf_outbound_inflight", "Sends waiting on the Bot API.", [({}, st["inflight"])])
+    out += gauge("werewolf_phase_timers", "Armed phase deadlines.", [({}, len(TIMERS))])
+    out += gauge("werewolf_store_dirty", "Games waiting for the next store flush.", [({}, len(STORE.dirty))])
+    out += ["# HELP werewolf_night_stage_seconds Night resolution time by pipeline stage, sampled nights.",
+            "# TYPE werewolf_night_stage_seconds summary"]
+    for stage, total in zip(STAGES, NIGHT.totals):
+        out += [f'werewolf_night_stage_seconds_sum{{stage="{stage}"}} {total}',
+                f'werewolf_night_stage_seconds_count{{stage="{stage}"}} {NIGHT.timed}']
+    out += gauge("werewolf_stats_pending", "Finished games waiting for the next stats flush.", [({}, len(STATS.pending))])
+    out += gauge("werewolf_locks_held", "Games with a handler running or waiting.", [({}, len(LOCKS))])
+    return out
+
+METRICS.collectors.append(collect_gauges)
+
+class WebhookHandler(tornado.web.RequestHandler):
+    # Telegram posts updates here, they go on the application's queue like PTB's own webhook does
+    def initialize(self, app):
+        self.app = app
+
+    async def post(self):
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            self.set_status(400)
+            return
+        await self.app.update_queue.put(Update.de_json(data, self.app.bot))
+
+async def serve(app):
+    # one tornado listener on PORT, /metrics always, /webhook when WEBHOOK_URL is set, polling otherwise.
+    # a shard worker serves /webhook for the dispatcher and leaves Telegram to it
+    worker = SHARD_COUNT > 1
+    routes = [(r"/metrics", MetricsHandler, {"registry": METRICS})]
+    if WEBHOOK_URL or worker:
+        routes.append((r"/webhook", WebhookHandler, {"app": app}))
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    async with app:
+        await app.post_init(app)
+        # the command menu is bot-wide, one shard sets it
+        if SHARD_INDEX == 0:
+            try:
+                await app.bot.set_my_commands([
+                    BotCommand("newgame","Buka lobby"),
+                    BotCommand("join","Masuk lobby"),
+                    BotCommand("preset","Pilih preset role"),
+                    BotCommand("startgame","Host mula game"),
+                    BotCommand("status","Status game"),
+                    BotCommand("stats","Statistik pemain"),
+                    BotCommand("leaderboard","Papan pendahulu"),
+                    BotCommand("votebuttons","Butang undi siang"),
+                    BotCommand("nextphase","Tamat siang ke malam"),
+                    BotCommand("night2day","Tamat malam ke siang"),
+                ])
+            except Exception:
+                pass
+        # a worker's /webhook takes any update it is sent, only the dispatcher on this host may reach it
+        server = tornado.web.Application(routes).listen(PORT, address="127.0.0.1" if worker else "0.0.0.0")
+        if WEBHOOK_URL and not worker:
+            await app.bot.set_webhook(f"{WEBHOOK_URL}/webhook", allowed_updates=Update.ALL_TYPES)
+        elif not worker:
+            await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        await app.start()
+        log.info("serving on port %d, %s", PORT,
+                 f"shard {SHARD_INDEX}/{SHARD_COUNT}" if worker else "webhook" if WEBHOOK_URL else "polling")
+        await stop.wait()
+        if app.updater.running:
+            await app.updater.stop()
+        await app.stop()
+        server.stop()
+        await app.post_shutdown(app)
+
 def main():
     # Optional local file fallback, do not commit your token
     if not BOT_TOKEN:
@@ -337,24 +911,7 @@ def main():
             "BOT_TOKEN not found, set env BOT_TOKEN, or TELEGRAM_BOT_TOKEN, "
             "or create local_config.py with TELEGRAM_TOKEN = '123:ABC...'"
         )
-    app = build_app()
-    # set UI commands
-    try:
-        app.bot.set_my_commands([
-            BotCommand("newgame","Buka lobby"),
-            BotCommand("join","Masuk lobby"),
-            BotCommand("startgame","Host mula game"),
-            BotCommand("status","Status game"),
-            BotCommand("votebuttons","Butang undi siang"),
-            BotCommand("nextphase","Tamat siang ke malam"),
-            BotCommand("night2day","Tamat malam ke siang"),
-        ])
-    except Exception:
-        pass
-    if WEBHOOK_URL:
-        app.run_webhook(listen="0.0.0.0", port=PORT, url_path="webhook", webhook_url=f"{WEBHOOK_URL}/webhook")
-    else:
-        app.run_polling(allowed_updates=Update.ALL_TYPES)
+    asyncio.run(serve(build_app()))
 
 if __name__ == "__main__":
     main()
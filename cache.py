@@ -0,0 +1,92 @@
+import asyncio, time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Hashable, Set, Tuple
+
+# bounded LRU for rendered objects keyed by (game key, ...), with per-game eviction
+class GameLRU:
+    def __init__(self, maxsize: int = 2048):
+        self.maxsize = maxsize
+        self.d: "OrderedDict[Tuple, object]" = OrderedDict()
+        self.by_game: Dict[Hashable, Set[Tuple]] = {}
+        self.hits = self.misses = 0
+
+    def get(self, key: Tuple, build: Callable[[], object]):
+        # key[0] is the game key
+        v = self.d.get(key)
+        if v is not None:
+            self.d.move_to_end(key)
+            self.hits += 1
+            return v
+        self.misses += 1
+        v = build()
+        self.d[key] = v
+        self.by_game.setdefault(key[0], set()).add(key)
+        if len(self.d) > self.maxsize:
+            old, _ = self.d.popitem(last=False)
+            keys = self.by_game.get(old[0])
+            if keys is not None:
+                keys.discard(old)
+                if not keys: del self.by_game[old[0]]
+        return v
+
+    def drop_game(self, gkey: Hashable):
+        for key in self.by_game.pop(gkey, ()):
+            self.d.pop(key, None)
+
+    def __len__(self):
+        return len(self.d)
+
+# async TTL cache with single-flight, concurrent misses on one key share a single fetch
+class AsyncTTLCache:
+    def __init__(self, ttl: float, maxsize: int = 10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.d: "OrderedDict[Hashable, Tuple[float, object]]" = OrderedDict()
+        self.inflight: Dict[Hashable, asyncio.Future] = {}
+        self.hits = self.misses = 0
+
+    async def get(self, key: Hashable, fetch: Callable[[], Awaitable[object]]):
+        while True:
+            hit = self.d.get(key)
+            if hit is not None and hit[0] > time.monotonic():
+                self.hits += 1
+                return hit[1]
+            fut = self.inflight.get(key)
+            if fut is None:
+                return await self._fetch(key, fetch)
+            try:
+                return await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                # the leader's task was cancelled, not this one, go round and the first waiter back fetches
+                if not fut.cancelled():
+                    raise
+
+    async def _fetch(self, key: Hashable, fetch: Callable[[], Awaitable[object]]):
+        self.misses += 1
+        fut = self.inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            v = await fetch()
+        except asyncio.CancelledError:
+            # the caller went away, waiters must not inherit its cancellation
+            fut.cancel()
+            raise
+        except BaseException as e:
+            fut.set_exception(e)
+            # mark retrieved, waiters re-raise it and nobody may be waiting
+            fut.exception()
+            raise
+        else:
+            fut.set_result(v)
+            self.d[key] = (time.monotonic() + self.ttl, v)
+            self.d.move_to_end(key)
+            if len(self.d) > self.maxsize:
+                self.d.popitem(last=False)
+            return v
+        finally:
+            self.inflight.pop(key, None)
+
+    def invalidate(self, key: Hashable):
+        self.d.pop(key, None)
+
+    def __len__(self):
+        return len(self.d)
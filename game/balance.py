@@ -0,0 +1,156 @@
+from __future__ import annotations
+import json, os, time, zlib
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Optional, Tuple
+from .roles import *
+from .sim import simulate
+
+# Deck builder, turns a preset from data/roles.json into a deck for n players and picks the wolf count
+# whose simulated village win rate is closest to even. Results are cached per (preset, players).
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+PRESETS_FILE = os.path.join(DATA_DIR, "roles.json")
+CACHE_FILE = os.getenv("DECK_CACHE", os.path.join(DATA_DIR, "deck_cache.json"))
+GAMES_PER_DECK = int(os.getenv("BALANCE_GAMES", "400"))
+CHUNK = 50  # games per pool job
+
+def parse_deck(spec) -> List[Role]:
+    # a list of role names, or a {name: count} map, the two formats a preset in data/roles.json may use, picked with /preset
+    if isinstance(spec, dict):
+        spec = [name for name, n in spec.items() for _ in range(int(n))]
+    deck = []
+    for name in spec:
+        role = ROLES_BY_NAME.get(name)
+        if role is None:
+            raise ValueError(f"unknown role {name!r}")
+        deck.append(role)
+    return deck
+
+def load_presets(path: str = PRESETS_FILE) -> Dict[str, List[Role]]:
+    # {preset: list or map}, a bare list or map is a single "classic" preset
+    with open(path, encoding="utf-8") as f:
+        raw = json.load(f)
+    if isinstance(raw, list) or raw and all(isinstance(v, int) for v in raw.values()):
+        raw = {"classic": raw}
+    return {name: parse_deck(spec) for name, spec in raw.items()}
+
+def expand(preset: List[Role], n: int, wolves: int) -> List[Role]:
+    # exactly n roles, the preset's first wolf roles up to wolves (Werewolf past those), the rest from the
+    # preset's other roles in order, Villagers past those
+    wolf_roles = [r for r in preset if r.alignment is Alignment.WOLF]
+    others = [r for r in preset if r.alignment is not Alignment.WOLF]
+    deck = (wolf_roles + [WEREWOLF] * wolves)[:wolves]
+    deck += (others + [VILLAGER] * n)[:n - wolves]
+    return deck
+
+def signature(preset: List[Role]) -> int:
+    # cached choices for a preset are dropped once its roles change
+    return zlib.crc32(",".join(r.name for r in preset).encode())
+
+def wolf_counts(n: int) -> range:
+    # one wolf up to a third of the table
+    return range(1, max(1, n // 3) + 1)
+
+def _play(job: Tuple[List[str], int, int, int]) -> Tuple[int, int, int]:
+    # pool worker, roles travel by name, Role identity does not survive pickling
+    names, n, seed, games = job
+    deck = [ROLES_BY_NAME[x] for x in names]
+    village = wolf = 0
+    for s in range(seed, seed + games):
+        r = simulate(n, deck, seed=s)
+        if r.winner == "village": village += 1
+        elif r.winner not in (None, "draw"): wolf += 1
+    return village, wolf, games - village - wolf
+
+@dataclass
+class DeckChoice:
+    roles: List[str]
+    wolves: int
+    village_rate: float  # village wins over decided games
+    games: int
+    sig: int = 0         # signature() of the preset it was built from
+
+    def deck(self) -> List[Role]:
+        return [ROLES_BY_NAME[x] for x in self.roles]
+
+def estimate(pool: Executor, deck: List[Role], n: int, games: int = GAMES_PER_DECK, seed: int = 0) -> Tuple[int, int, int]:
+    # (village wins, other factions' wins, draws and unfinished) over games simulated in CHUNK sized pool jobs
+    names = [r.name for r in deck]
+    jobs = [(names, n, seed + i, min(CHUNK, games - i)) for i in range(0, games, CHUNK)]
+    v = w = d = 0
+    for a, b, c in pool.map(_play, jobs):
+        v += a; w += b; d += c
+    return v, w, d
+
+def balance(pool: Executor, preset: List[Role], n: int, games: int = GAMES_PER_DECK) -> DeckChoice:
+    best = None
+    for wolves in wolf_counts(n):
+        deck = expand(preset, n, wolves)
+        v, w, _ = estimate(pool, deck, n, games)
+        rate = v / (v + w) if v + w else 0.5
+        if best is None or abs(rate - 0.5) < abs(best.village_rate - 0.5):
+            best = DeckChoice([r.name for r in deck], wolves, rate, games, signature(preset))
+    return best
+
+class DeckCache:
+    # (preset, players) -> DeckChoice, kept in a json file so a restart does not re-simulate
+    def __init__(self, path: str = CACHE_FILE, presets: Optional[Dict[str, List[Role]]] = None):
+        self.path = path
+        self.presets = presets if presets is not None else load_presets()
+        self.choices: Dict[Tuple[str, int], DeckChoice] = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    for key, c in json.load(f).items():
+                        name, n = key.rsplit("/", 1)
+                        c = DeckChoice(**c)
+                        if name in self.presets and c.sig == signature(self.presets[name]):
+                            self.choices[(name, int(n))] = c
+            except (ValueError, TypeError):
+                self.choices = {}
+
+    def get(self, preset: str, n: int) -> Optional[DeckChoice]:
+        return self.choices.get((preset, n))
+
+    def fallback(self, preset: str, n: int) -> List[Role]:
+        # instant deck while the simulated one is not ready, about one wolf per four players
+        return expand(self.presets[preset], n, max(1, n // 4))
+
+    def deck_for(self, preset: str, n: int) -> List[Role]:
+        c = self.get(preset, n)
+        return c.deck() if c else self.fallback(preset, n)
+
+    def build(self, pool: Executor, preset: str, n: int, games: int = GAMES_PER_DECK) -> DeckChoice:
+        # blocking, run it off the event loop
+        c = self.choices[(preset, n)] = balance(pool, self.presets[preset], n, games)
+        return c
+
+    def save(self):
+        if not self.path:
+            return
+        # shard workers share the file, each writes its own temp file and the last rename wins
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({f"{p}/{n}": asdict(c) for (p, n), c in sorted(self.choices.items())}, f, indent=1)
+        os.replace(tmp, self.path)
+
+def main():
+    # python -m game.balance [min players] [max players] [games per deck], fills the cache file
+    import sys
+    args = [int(a) for a in sys.argv[1:]]
+    lo = args[0] if len(args) > 0 else 5
+    hi = args[1] if len(args) > 1 else 20
+    games = args[2] if len(args) > 2 else GAMES_PER_DECK
+    cache = DeckCache()
+    t = time.perf_counter()
+    with ProcessPoolExecutor() as pool:
+        for preset in cache.presets:
+            for n in range(lo, hi + 1):
+                c = cache.build(pool, preset, n, games)
+                print(f"{preset:<10}{n:>4} players  {c.wolves} wolves  village {c.village_rate:.2f}")
+    cache.save()
+    print(f"{len(cache.presets) * (hi - lo + 1)} decks in {time.perf_counter() - t:.1f}s, written to {cache.path}")
+
+if __name__ == "__main__":
+    main()
@@ -4,15 +4,59 @@ from dataclasses import dataclass, field
 from typing import Dict, List, Optional, Tuple, Set
 import random
 from .roles import *
-
-@dataclass
+from .tally import Tally
+from .night import NightPipeline, NightTable
+
+WOLF_ROLES = (WEREWOLF, WOLF_CUB, LONE_WOLF, MINION)
+
+# factions for the win check. Vampire and cult membership come from conversions and win over the
+# role's own alignment, neutral roles without a faction only count toward the living
+VILLAGE, WOLVES, VAMPIRES, CULT, NEUTRAL = "village", "wolves", "vampires", "cult", "neutral"
+ALIGNMENT_TEAM = {Alignment.VILLAGE: VILLAGE, Alignment.WOLF: WOLVES, Alignment.NEUTRAL: NEUTRAL}
+WIN_TEXT = {
+    VILLAGE: "🏆 Kampung menang, semua serigala, vampire dan cult tumbang.",
+    WOLVES: "🐺 Serigala menang.",
+    VAMPIRES: "🧛 Vampire menang.",
+    CULT: "✝ Cult menang, semua yang hidup sudah join.",
+    "draw": "☠️ Semua mati, seri.",
+}
+
+# night action code -> (Game method, roles that may use it), shared with the bot for prompts and callbacks
+NIGHT_ACTIONS: Dict[str, Tuple[str, Tuple[Role, ...]]] = {
+    "kill": ("wolf_kill", WOLF_ROLES),
+    "peek": ("seer_peek", (SEER,)),
+    "aura": ("aura_peek", (AURA_SEER,)),
+    "save": ("doctor_save", (DOCTOR,)),
+    "protect": ("bodyguard_protect", (BODYGUARD,)),
+    "heal": ("witch_heal", (WITCH,)),
+    "poison": ("witch_poison", (WITCH,)),
+    "bless": ("priest_bless", (PRIEST,)),
+    "scry": ("sorceress_scry", (SORCERESS,)),
+    "bite": ("vampire_bite", (VAMPIRE,)),
+    "recruit": ("cult_recruit", (CULT_LEADER,)),
+}
+
+# role -> its night action codes, in prompt order
+ROLE_ACTIONS: Dict[Role, Tuple[str, ...]] = {}
+for _code, (_meth, _roles) in NIGHT_ACTIONS.items():
+    for _r in _roles:
+        ROLE_ACTIONS[_r] = ROLE_ACTIONS.get(_r, ()) + (_code,)
+
+# snapshots written before the per-night table stored one field per action
+LEGACY_NIGHT_FIELDS = {
+    "seer_target": "peek", "aura_target": "aura", "sorc_target": "scry", "priest_target": "bless",
+    "doctor_target": "save", "bodyguard_target": "protect", "witch_heal_target": "heal",
+    "witch_poison_target": "poison", "vampire_target": "bite", "cult_target": "recruit",
+}
+
+@dataclass(slots=True)
 class PlayerState:
     user_id: int
     name: str
     role: Role = VILLAGER
     alive: bool = True
 
-@dataclass
+@dataclass(slots=True)
 class Game:
     chat_id: int
     thread_id: int = 0
@@ -20,31 +64,48 @@ class Game:
     host_id: Optional[int] = None
     phase: str = "lobby"  # lobby, day, night, end
     day: int = 0
+    # gid tells this game from earlier ones in the same chat, set by the bot. epoch goes up on every
+    # phase change, buttons carry both so presses from an old game or phase are dropped unread
+    gid: int = 0
+    epoch: int = 0
+    # the deal's shuffle is seeded from this, so a game's roles follow from its seed and roster alone
+    seed: int = 0
+    # deck preset from data/roles.json, picked in the lobby with /preset
+    preset: str = "classic"
 
     players: Dict[int, PlayerState] = field(default_factory=dict)  # uid -> PlayerState
     order: List[int] = field(default_factory=list)  # seating order
 
+    # alive roster caches, only touched on join or death. roster_version goes up on every
+    # change so callers can key their own caches on it
+    alive_set: Set[int] = field(default_factory=set, repr=False)
+    alive_order: List[int] = field(default_factory=list, repr=False)
+    seats: Dict[int,int] = field(default_factory=dict, repr=False)  # alive uid -> seat number
+    roster_version: int = 0
+
     # day
     votes: Dict[int, object] = field(default_factory=dict) # voter uid -> target uid or "skip"
+    vote_tally: Tally = field(default_factory=Tally, repr=False, compare=False)
 
     # night actions
     wolf_votes: Dict[int, int] = field(default_factory=dict)
-    seer_target: Optional[int] = None
-    aura_target: Optional[int] = None
-    sorc_target: Optional[int] = None
-    priest_target: Optional[int] = None
-    doctor_target: Optional[int] = None
-    bodyguard_target: Optional[int] = None
-    witch_heal_target: Optional[int] = None
-    witch_poison_target: Optional[int] = None
-    vampire_target: Optional[int] = None
-    cult_target: Optional[int] = None
+    wolf_tally: Tally = field(default_factory=Tally, repr=False, compare=False)
+    # this night's single-target actions, action code -> target uid, wolves use wolf_votes
+    night: Dict[str, int] = field(default_factory=dict)
+    # (uid, action code) still to come tonight, filled when night opens, see waiting_on(). One entry per
+    # prompt, the witch has one per potion left and clears each by using or passing it
+    night_pending: Set[Tuple[int,str]] = field(default_factory=set, repr=False)
 
     # resources
     witch_heal_available: bool = True
     witch_poison_available: bool = True
     bodyguard_last_target: Optional[int] = None
 
+    # wall clock of the last update that touched this game, drives idle eviction
+    last_active: float = 0.0
+    # wall clock when the current day or night auto-resolves, 0 for none
+    deadline: float = 0.0
+
     # ui msg ids
     vote_msg_id: Optional[int] = None
     day_banner_id: Optional[int] = None
@@ -54,26 +115,124 @@ class Game:
     vampires: Set[int] = field(default_factory=set)
     cult: Set[int] = field(default_factory=set)
     masons: Set[int] = field(default_factory=set)
+    # night-action role -> alive uids holding it, built by assign_roles, dead players leave it in kill().
+    # passive roles are not indexed, nothing dispatches on them
+    role_index: Dict[Role, Set[int]] = field(default_factory=dict, repr=False)
+
+    # alive players per faction and each player's faction, moved on every death and conversion so the
+    # win check never rescans the table
+    team: Dict[int, str] = field(default_factory=dict, repr=False)
+    team_alive: Dict[str, int] = field(default_factory=dict, repr=False)
+    winner: Optional[str] = None  # faction or "draw" once phase is "end"
+    # uids hanged by day vote, in order, the rest of the dead fell at night
+    lynched: List[int] = field(default_factory=list, repr=False)
+
+    # append-only log of state-changing calls, None when not recording, see replay.py. Entries are
+    # tuples, the first item says what was called, the owner drains the list as it writes it out
+    events: Optional[List[tuple]] = field(default=None, repr=False, compare=False)
+
+    # shared uid -> (chat_id, thread_id) index owned by the bot, None when running headless
+    index: Optional[Dict[int, Tuple[int,int]]] = field(default=None, repr=False, compare=False)
+
+    @property
+    def key(self) -> Tuple[int,int]:
+        return (self.chat_id, self.thread_id)
 
     def add_player(self, uid:int, name:str) -> str:
+        if self.events is not None: self.events.append(("j", uid, name))
         if uid in self.players:
             return "Already in lobby."
         self.players[uid] = PlayerState(uid, name)
         self.order.append(uid)
+        self.alive_set.add(uid)
+        self.alive_order.append(uid)
+        self.seats[uid] = len(self.order)
+        self.roster_version += 1
+        # last join wins, a user sitting in several games is routed to the newest one
+        if self.index is not None:
+            self.index[uid] = self.key
         return f"{name} joined."
 
+    # --- Persistence ---
+    def to_state(self) -> dict:
+        # compact, json friendly snapshot, derived caches are rebuilt on load
+        return {
+            "c": self.chat_id, "t": self.thread_id, "h": self.host_id, "p": self.phase, "d": self.day,
+            "e": [self.gid, self.epoch],
+            "sd": self.seed,
+            "ps": self.preset,
+            "pl": [[uid, self.players[uid].name, self.players[uid].role.name, int(self.players[uid].alive)] for uid in self.order],
+            "v": list(self.votes.items()),
+            "wv": list(self.wolf_votes.items()),
+            "n": self.night,
+            "r": [self.witch_heal_available, self.witch_poison_available, self.bodyguard_last_target],
+            "ui": [self.vote_msg_id, self.day_banner_id],
+            "tm": [list(self.wolves), list(self.vampires), list(self.cult), list(self.masons)],
+            "la": self.last_active,
+            "dl": self.deadline,
+            "w": self.winner,
+            "ly": self.lynched,
+        }
+
+    @classmethod
+    def from_state(cls, st: dict) -> "Game":
+        g = cls(chat_id=st["c"], thread_id=st["t"], host_id=st["h"], phase=st["p"], day=st["d"])
+        g.gid, g.epoch = st.get("e", (0, 0))
+        g.seed = st.get("sd", 0)
+        g.preset = st.get("ps", "classic")
+        dead = []
+        for uid, name, role, alive in st["pl"]:
+            g.add_player(uid, name)
+            ps = g.players[uid]
+            ps.role = ROLES_BY_NAME.get(role, VILLAGER)
+            if g.phase != "lobby" and ps.role in ROLE_ACTIONS:
+                g.role_index.setdefault(ps.role, set()).add(uid)
+            if not alive: dead.append(uid)
+        for uid in dead:
+            g.kill(uid)
+        for voter, target in st["v"]:
+            g.vote_tally.change(None, target); g.votes[voter] = target
+        for wolf, target in st["wv"]:
+            g.wolf_tally.change(None, target); g.wolf_votes[wolf] = target
+        for code, v in st["n"].items():
+            g.night[LEGACY_NIGHT_FIELDS.get(code, code)] = v
+        g.witch_heal_available, g.witch_poison_available, g.bodyguard_last_target = st["r"]
+        g.vote_msg_id, g.day_banner_id = st["ui"]
+        g.wolves, g.vampires, g.cult, g.masons = (set(x) for x in st["tm"])
+        g.last_active = st.get("la", 0.0)
+        g.deadline = st.get("dl", 0.0)
+        g.winner = st.get("w")
+        g.lynched = list(st.get("ly", ()))
+        if g.phase != "lobby":
+            g.count_teams()
+        if g.phase == "night":
+            g.open_night()
+            for uid, code in list(g.night_pending):
+                if uid in g.wolf_votes if code == "kill" else code in g.night:
+                    g.night_pending.discard((uid, code))
+        return g
+
     def assign_roles(self, deck: List[Role]) -> str:
+        if self.events is not None: self.events.append(("r", [r.name for r in deck]))
+        # built per deal rather than kept on the game, a Random is 2.5 KB and the deal is its only draw
+        rng = random.Random(self.seed)
         uids = list(self.players.keys())
-        random.shuffle(uids)
+        rng.shuffle(uids)
         pool = list(deck)
-        random.shuffle(pool)
+        rng.shuffle(pool)
         if len(pool) < len(uids):
             pool += [VILLAGER] * (len(uids)-len(pool))
+        self.role_index.clear()
+        # a second deal starts the teams over, the win counters are built from them
+        self.wolves.clear(); self.masons.clear(); self.vampires.clear(); self.cult.clear()
+        self.lynched.clear()
         for uid, role in zip(uids, pool[:len(uids)]):
             ps = self.players[uid]
             ps.role = role
+            if role in ROLE_ACTIONS:
+                self.role_index.setdefault(role, set()).add(uid)
             # track teams
-            if role in (WEREWOLF, WOLF_CUB, LONE_WOLF, MINION):
+            if role in WOLF_ROLES:
                 self.wolves.add(uid)
             if role == MASON:
                 self.masons.add(uid)
@@ -81,174 +240,299 @@ class Game:
                 self.vampires.add(uid)
             if role == CULT_LEADER:
                 self.cult.add(uid)
+        self.count_teams()
         self.phase = "day"
         self.day = 1
-        self.votes.clear()
+        self.epoch += 1
+        self.votes.clear(); self.vote_tally.clear()
         # reset night actions
-        self.wolf_votes.clear()
-        self.seer_target = self.aura_target = self.sorc_target = self.priest_target = None
-        self.doctor_target = self.bodyguard_target = None
-        self.witch_heal_target = self.witch_poison_target = None
-        self.vampire_target = self.cult_target = None
+        self.wolf_votes.clear(); self.wolf_tally.clear()
+        self.night.clear()
         return "🎬 Roles assigned. Check your DM."
 
+    # --- Factions and win check ---
+    def faction(self, uid: int) -> str:
+        if uid in self.vampires: return VAMPIRES
+        if uid in self.cult: return CULT
+        if uid in self.wolves: return WOLVES
+        return ALIGNMENT_TEAM[self.players[uid].role.alignment]
+
+    def count_teams(self):
+        # full build, at role assignment and on load, everything after is incremental
+        self.team = {uid: self.faction(uid) for uid in self.players}
+        self.team_alive = dict.fromkeys((VILLAGE, WOLVES, VAMPIRES, CULT, NEUTRAL), 0)
+        for uid in self.alive_set:
+            self.team_alive[self.team[uid]] += 1
+
+    def convert(self, uid: int, team: str):
+        # bite or recruit, the role stays, only the faction moves
+        (self.vampires if team == VAMPIRES else self.cult).add(uid)
+        old = self.team.get(uid)
+        new = self.faction(uid)
+        if old != new and uid in self.alive_set:
+            self.team_alive[old] -= 1
+            self.team_alive[new] += 1
+        self.team[uid] = new
+
+    def check_win(self) -> Optional[str]:
+        # O(1) on the counters, ends the game and returns the winner, None while it goes on
+        alive = len(self.alive_set)
+        n = self.team_alive
+        w, v, c = n[WOLVES], n[VAMPIRES], n[CULT]
+        if alive == 0: win = "draw"
+        elif c == alive: win = CULT
+        elif w == 0 and v == 0 and c == 0: win = VILLAGE
+        elif v == 0 and w * 2 >= alive: win = WOLVES
+        elif w == 0 and v * 2 >= alive: win = VAMPIRES
+        else: return None
+        self.winner = win
+        self.phase = "end"
+        return win
+
+    def at_seat(self, seat: int) -> Optional[int]:
+        # uid at a 1-based seat number, None when out of range
+        return self.order[seat-1] if 0 < seat <= len(self.order) else None
+
     def list_alive_numbers(self) -> Dict[int,int]:
-        # map uid -> number
-        mapping = {}
-        for i, uid in enumerate(self.order, start=1):
-            if self.players[uid].alive:
-                mapping[uid] = i
-        return mapping
+        # map uid -> number, cached, do not mutate
+        return self.seats
 
     def alive_list(self) -> List[int]:
-        return [uid for uid in self.order if self.players[uid].alive]
+        # alive uids in seating order, cached, do not mutate
+        return self.alive_order
+
+    def is_alive(self, uid) -> bool:
+        return uid in self.alive_set
+
+    def kill(self, uid:int):
+        ps = self.players[uid]
+        if not ps.alive:
+            return
+        ps.alive = False
+        self.alive_set.discard(uid)
+        self.alive_order.remove(uid)
+        self.seats.pop(uid, None)
+        holders = self.role_index.get(ps.role)
+        if holders: holders.discard(uid)
+        t = self.team.get(uid)
+        if t: self.team_alive[t] -= 1
+        self.roster_version += 1
+
+    def has_role(self, uid, role: Role) -> bool:
+        return uid in self.role_index.get(role, ())
+
+    def night_actors(self):
+        # yields (uid, action code) for every alive player with a night action, one pass over the index.
+        # the pack's kill only goes to players still on the wolves' side
+        team = self.team
+        for role, uids in self.role_index.items():
+            codes = ROLE_ACTIONS[role]
+            for uid in uids:
+                for code in codes:
+                    if code == "kill" and team.get(uid) != WOLVES:
+                        continue
+                    yield uid, code
+
+    def open_night(self):
+        # everyone with a usable night action is expected, the witch only while a potion is left
+        pending = self.night_pending
+        pending.clear()
+        for uid, code in self.night_actors():
+            if code == "heal" and not self.witch_heal_available or code == "poison" and not self.witch_poison_available:
+                continue
+            pending.add((uid, code))
+
+    def waiting_on(self) -> int:
+        # votes or night actions still expected this phase, day non-voters or pending night prompts, O(1)
+        if self.phase == "day":
+            return len(self.alive_set) - len(self.votes)
+        if self.phase == "night":
+            return len(self.night_pending)
+        return 0
 
     # --- Day voting ---
     def vote(self, voter:int, target:object) -> str:
+        if self.events is not None: self.events.append(("v", voter, target))
         if self.phase != "day": return "Not day."
-        if voter not in self.players or not self.players[voter].alive: return "You are not alive."
-        if target!="skip" and (target not in self.players or not self.players[target].alive): return "Invalid target."
+        if voter not in self.alive_set: return "You are not alive."
+        if target!="skip" and target not in self.alive_set: return "Invalid target."
+        self.vote_tally.change(self.votes.get(voter), target)
         self.votes[voter] = target
         return "Vote recorded."
 
+    def vote_counts(self) -> Dict[object,int]:
+        # target uid or "skip" -> votes, live view, do not mutate
+        return self.vote_tally.counts
+
     def tally(self) -> Tuple[Optional[int], bool]:
         # returns, target uid or None, and whether tie/skip
-        counts={}
-        for tgt in self.votes.values():
-            counts[tgt]=counts.get(tgt,0)+1
-        if not counts: return None, True
-        # find max
-        mx = max(counts.values())
-        winners=[t for t,n in counts.items() if n==mx]
-        if len(winners)>1: return None, True
-        winner = winners[0]
-        if winner=="skip": return None, True
+        winner, tie = self.vote_tally.leader()
+        if tie or winner=="skip": return None, True
         return int(winner), False
 
     # --- Night actions ---
+    def act(self, code: str, uid: int, target: int) -> str:
+        # one entry point for every night action, by NIGHT_ACTIONS code, so the log sees them all
+        # target None passes, the action is not used tonight and the night stops waiting for it
+        if self.events is not None: self.events.append(("n", code, uid, target))
+        if target is None:
+            if self.phase != "night" or (uid, code) not in self.night_pending: return "Nothing to pass."
+            self.night_pending.discard((uid, code))
+            return "Passed."
+        return getattr(self, NIGHT_ACTIONS[code][0])(uid, target)
+
     def wolf_kill(self, uid:int, target:int) -> str:
         if self.phase!="night": return "Not night."
-        if uid not in self.wolves: return "Not a wolf."
-        if target not in self.alive_list(): return "Invalid target."
+        # a bitten or recruited wolf keeps the role but has left the pack
+        if uid not in self.alive_set or self.team.get(uid) != WOLVES: return "Not a wolf."
+        if target not in self.alive_set: return "Invalid target."
+        self.wolf_tally.change(self.wolf_votes.get(uid), target)
         self.wolf_votes[uid]=target
+        self.night_pending.discard((uid, "kill"))
         return "Wolf vote recorded."
 
     def seer_peek(self, uid:int, target:int) -> str:
         if self.phase!="night": return "Not night."
-        if self.players[uid].role!=SEER: return "Not Seer."
-        self.seer_target=target; return "Seen."
+        if not self.has_role(uid, SEER): return "Not Seer."
+        self.night["peek"]=target; self.night_pending.discard((uid, "peek")); return "Seen."
 
     def aura_peek(self, uid:int, target:int) -> str:
         if self.phase!="night": return "Not night."
-        if self.players[uid].role!=AURA_SEER: return "Not Aura Seer."
-        self.aura_target=target; return "Aura read."
+        if not self.has_role(uid, AURA_SEER): return "Not Aura Seer."
+        self.night["aura"]=target; self.night_pending.discard((uid, "aura")); return "Aura read."
 
     def sorceress_scry(self, uid:int, target:int) -> str:
         if self.phase!="night": return "Not night."
-        if self.players[uid].role!=SORCERESS: return "Not Sorceress."
-        self.sorc_target=target; return "Scry set."
+        if not self.has_role(uid, SORCERESS): return "Not Sorceress."
+        self.night["scry"]=target; self.night_pending.discard((uid, "scry")); return "Scry set."
 
     def priest_bless(self, uid:int, target:int) -> str:
         if self.phase!="night": return "Not night."
-        if self.players[uid].role!=PRIEST: return "Not Priest."
-        self.priest_target=target; return "Bless set."
+        if not self.has_role(uid, PRIEST): return "Not Priest."
+        self.night["bless"]=target; self.night_pending.discard((uid, "bless")); return "Bless set."
 
     def doctor_save(self, uid:int, target:int) -> str:
         if self.phase!="night": return "Not night."
-        if self.players[uid].role!=DOCTOR: return "Not Doctor."
-        self.doctor_target=target; return "Save set."
+        if not self.has_role(uid, DOCTOR): return "Not Doctor."
+        self.night["save"]=target; self.night_pending.discard((uid, "save")); return "Save set."
 
     def bodyguard_protect(self, uid:int, target:int) -> str:
         if self.phase!="night": return "Not night."
-        if self.players[uid].role!=BODYGUARD: return "Not Bodyguard."
-        self.bodyguard_target=target; return "Protect set."
+        if not self.has_role(uid, BODYGUARD): return "Not Bodyguard."
+        self.night["protect"]=target; self.night_pending.discard((uid, "protect")); return "Protect set."
 
     def witch_heal(self, uid:int, target:int) -> str:
         if self.phase!="night": return "Not night."
-        if self.players[uid].role!=WITCH or not self.witch_heal_available: return "Cannot heal."
-        self.witch_heal_target=target; return "Heal used."
+        if not self.has_role(uid, WITCH) or not self.witch_heal_available: return "Cannot heal."
+        self.night["heal"]=target; self.night_pending.discard((uid, "heal")); return "Heal used."
 
     def witch_poison(self, uid:int, target:int) -> str:
         if self.phase!="night": return "Not night."
-        if self.players[uid].role!=WITCH or not self.witch_poison_available: return "Cannot poison."
-        self.witch_poison_target=target; return "Poison set."
+        if not self.has_role(uid, WITCH) or not self.witch_poison_available: return "Cannot poison."
+        self.night["poison"]=target; self.night_pending.discard((uid, "poison")); return "Poison set."
 
     def vampire_bite(self, uid:int, target:int) -> str:
         if self.phase!="night": return "Not night."
-        if self.players[uid].role!=VAMPIRE: return "Not Vampire."
-        self.vampire_target=target; return "Bite set."
+        if not self.has_role(uid, VAMPIRE): return "Not Vampire."
+        self.night["bite"]=target; self.night_pending.discard((uid, "bite")); return "Bite set."
 
     def cult_recruit(self, uid:int, target:int) -> str:
         if self.phase!="night": return "Not night."
-        if self.players[uid].role!=CULT_LEADER: return "Not Cult Leader."
-        self.cult_target=target; return "Recruit set."
+        if not self.has_role(uid, CULT_LEADER): return "Not Cult Leader."
+        self.night["recruit"]=target; self.night_pending.discard((uid, "recruit")); return "Recruit set."
 
     # --- Phase resolution ---
     def resolve_day(self) -> str:
+        if self.events is not None: self.events.append(("D",))
+        self.epoch += 1
         target, tie = self.tally()
-        self.votes.clear()
+        self.votes.clear(); self.vote_tally.clear()
         if tie or target is None:
             self.phase="night"
+            self.open_night()
             return "📢 Hari tamat, tiada lynch. 🌙 Malam bermula."
         # lynch target
-        self.players[target].alive=False
+        self.kill(target)
+        self.lynched.append(target)
+        text = f"📢 Hari tamat, {self.players[target].name} digantung."
+        win = self.check_win()
+        if win:
+            return f"{text}\n{WIN_TEXT[win]}"
         self.phase="night"
-        return f"📢 Hari tamat, {self.players[target].name} digantung. 🌙 Malam bermula."
+        self.open_night()
+        return f"{text} 🌙 Malam bermula."
 
     def resolve_night(self) -> str:
-        victims=[]
-        # wolf kill by plurality
-        if self.wolf_votes:
-            tally={}
-            for t in self.wolf_votes.values():
-                tally[t]=tally.get(t,0)+1
-            wolf_target = max(tally, key=tally.get)
+        if self.events is not None: self.events.append(("N",))
+        self.epoch += 1
+        dead = NIGHT.run(self).victims
+        if dead:
+            names=", ".join(self.players[v].name for v in dead)
+            text = f"🌙 Malam berakhir. 💀 Tumbang, {names}."
         else:
-            wolf_target=None
-
-        saved=set()
-        if self.doctor_target: saved.add(self.doctor_target)
-        if self.bodyguard_target:
-            saved.add(self.bodyguard_target)
-            self.bodyguard_last_target=self.bodyguard_target
-
-        # witch heal overrides, if set
-        if self.witch_heal_target: saved.add(self.witch_heal_target)
-        # apply wolf kill
-        if wolf_target and wolf_target not in saved and self.players.get(wolf_target, None) and self.players[wolf_target].alive:
-            victims.append(wolf_target)
-
-        # witch poison death
-        if self.witch_poison_target and self.players.get(self.witch_poison_target, None) and self.players[self.witch_poison_target].alive:
-            victims.append(self.witch_poison_target)
-
-        # vampire converts, not kill
-        if self.vampire_target and self.players.get(self.vampire_target, None) and self.players[self.vampire_target].alive:
-            self.vampires.add(self.vampire_target)
-
-        # cult recruit
-        if self.cult_target and self.players.get(self.cult_target, None) and self.players[self.cult_target].alive:
-            self.cult.add(self.cult_target)
-
-        # mark deaths
-        unique_victims=[]
-        for v in victims:
-            if v not in unique_victims:
-                unique_victims.append(v)
-        for v in unique_victims:
-            self.players[v].alive=False
-
-        # reset night actions
-        self.wolf_votes.clear()
-        self.seer_target=self.aura_target=self.sorc_target=self.priest_target=None
-        self.doctor_target=self.bodyguard_target=None
-        self.witch_heal_target=self.witch_poison_target=None
-        self.vampire_target=self.cult_target=None
-
+            text = "🌙 Malam berakhir. 👍 Tiada kematian."
+        win = self.check_win()
+        if win:
+            return f"{text}\n{WIN_TEXT[win]}"
         self.phase="day"; self.day+=1
-
-        if unique_victims:
-            names=", ".join(self.players[v].name for v in unique_victims)
-            return f"🌙 Malam berakhir. 💀 Tumbang, {names}. 🌞 Day {self.day} bermula."
-        else:
-            return f"🌙 Malam berakhir. 👍 Tiada kematian. 🌞 Day {self.day} bermula."
+        return f"{text} 🌞 Day {self.day} bermula."
+
+# --- night resolution stages, see night.py. Order inside a stage is registration order ---
+NIGHT = NightPipeline()
+
+@NIGHT.stage("collect")
+def wolves_pick(g: Game, t: NightTable):
+    # wolf kill by plurality
+    t.wolf_target = g.wolf_tally.plurality()
+
+@NIGHT.stage("protect", "save")
+def doctor_saves(g: Game, t: NightTable):
+    t.saved.add(t.actions["save"])
+
+@NIGHT.stage("protect", "protect")
+def bodyguard_guards(g: Game, t: NightTable):
+    t.saved.add(t.actions["protect"])
+    g.bodyguard_last_target = t.actions["protect"]
+
+@NIGHT.stage("protect", "heal")
+def witch_heals(g: Game, t: NightTable):
+    t.saved.add(t.actions["heal"])
+
+@NIGHT.stage("kill")
+def wolves_kill(g: Game, t: NightTable):
+    v = t.wolf_target
+    if v and v not in t.saved and v in g.alive_set:
+        t.victims.setdefault(v, WOLVES)
+
+@NIGHT.stage("kill", "poison")
+def witch_poisons(g: Game, t: NightTable):
+    # no save stops poison
+    v = t.actions["poison"]
+    if v in g.alive_set:
+        t.victims.setdefault(v, "poison")
+
+@NIGHT.stage("convert", "bite")
+def vampire_bites(g: Game, t: NightTable):
+    # a conversion, not a kill. The role stays, so role_index is untouched
+    v = t.actions["bite"]
+    if v in g.alive_set:
+        g.convert(v, VAMPIRES)
+        t.converts.append((v, VAMPIRES))
+
+@NIGHT.stage("convert", "recruit")
+def cult_recruits(g: Game, t: NightTable):
+    v = t.actions["recruit"]
+    if v in g.alive_set:
+        g.convert(v, CULT)
+        t.converts.append((v, CULT))
+
+@NIGHT.stage("reveal")
+def mark_dead(g: Game, t: NightTable):
+    # after conversions, a bitten victim dies on the vampires' count
+    for v in t.victims:
+        g.kill(v)
+
+@NIGHT.stage("cleanup")
+def reset_night(g: Game, t: NightTable):
+    g.wolf_votes.clear(); g.wolf_tally.clear()
+    g.night.clear(); g.night_pending.clear()
@@ -0,0 +1,75 @@
+from __future__ import annotations
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+# Night resolution as an ordered pipeline. Every stage reads and writes one NightTable, the night's
+# actions as players sent them plus what earlier stages decided. Roles hook in with NightPipeline.stage,
+# the rules for the shipped roles are registered at the bottom of game.py
+
+# in run order
+STAGES = ("collect", "protect", "kill", "convert", "reveal", "cleanup")
+
+class NightTable:
+    __slots__ = ("actions", "wolf_target", "saved", "victims", "converts")
+
+    def __init__(self, actions: Dict[str, int]):
+        self.actions = actions                      # action code -> target uid, the game's night dict
+        self.wolf_target: Optional[int] = None
+        self.saved: Set[int] = set()
+        # uid -> cause, first cause wins and insertion order is announcement order, so a player hit twice dies once
+        self.victims: Dict[int, str] = {}
+        self.converts: List[Tuple[int, str]] = []  # (uid, faction), in order
+
+# (stage function, the action code it needs or None to always run)
+Hook = Tuple[Callable[["object", NightTable], None], Optional[str]]
+
+# one night in SAMPLE is timed stage by stage, reading the clock on every night costs more than some stages
+SAMPLE = 16
+
+class NightPipeline:
+    def __init__(self, sample: int = SAMPLE):
+        self.hooks: Dict[str, List[Hook]] = {s: [] for s in STAGES}
+        self.plan: List[List[Hook]] = list(self.hooks.values())
+        self.flat: List[Hook] = []  # every hook in run order, for untimed nights
+        self.sample = sample
+        # seconds per stage summed over the timed nights, in STAGES order, read by the bench and /metrics
+        self.totals: List[float] = [0.0] * len(STAGES)
+        self.timed = 0
+        self.runs = 0
+
+    def seconds(self) -> Dict[str, float]:
+        # mean seconds per stage over the timed nights
+        return {s: t / self.timed if self.timed else 0.0 for s, t in zip(STAGES, self.totals)}
+
+    def stage(self, name: str, action: Optional[str] = None):
+        # decorator, fn(game, table) runs in stage name after the hooks already there. With an action code
+        # it only runs on nights where that action was used
+        if name not in self.hooks:
+            raise ValueError(f"unknown night stage {name!r}, one of {', '.join(STAGES)}")
+        def register(fn):
+            self.hooks[name].append((fn, action))
+            self.flat = [h for hooks in self.plan for h in hooks]
+            return fn
+        return register
+
+    def run(self, g) -> NightTable:
+        table = NightTable(g.night)
+        acts = table.actions
+        self.runs += 1
+        if self.runs % self.sample:
+            for fn, action in self.flat:
+                if action is None or action in acts:
+                    fn(g, table)
+            return table
+        clock = time.perf_counter
+        marks = [clock()]
+        for hooks in self.plan:
+            for fn, action in hooks:
+                if action is None or action in acts:
+                    fn(g, table)
+            marks.append(clock())
+        totals = self.totals
+        for i in range(len(totals)):
+            totals[i] += marks[i + 1] - marks[i]
+        self.timed += 1
+        return table
@@ -0,0 +1,105 @@
+from __future__ import annotations
+import json, os
+from typing import Dict, Iterable, List, Tuple
+from .game import Game
+from .balance import parse_deck
+
+# Event log and replay. A recording Game appends one tuple per state-changing call to g.events:
+#   ("g", seed)                      game created, first entry of a log
+#   ("j", uid, name)                 add_player
+#   ("r", [role names])              assign_roles, the deck as passed in, the seed decides the deal
+#   ("v", voter, target)             vote, target is a uid or "skip"
+#   ("n", code, uid, target)         act, a night action by NIGHT_ACTIONS code
+#   ("D",) ("N",)                    resolve_day, resolve_night
+# Rejected calls are logged too, replaying them is rejected the same way. Everything else a Game holds
+# follows from these, so feeding them back into a fresh Game rebuilds it exactly.
+#
+# On disk a log is json lines, [chat_id, thread_id, gid, [entry, ...]], one line per game per flush.
+# A game's entries are the concatenation of its lines in file order
+
+GameId = Tuple[int, int, int]  # chat_id, thread_id, gid
+
+def start(g: Game):
+    # begin recording a new game
+    g.events = [("g", g.seed)]
+
+def apply(g: Game, ev) -> None:
+    op = ev[0]
+    if op == "v": g.vote(ev[1], ev[2])
+    elif op == "n": g.act(ev[1], ev[2], ev[3])
+    elif op == "j": g.add_player(ev[1], ev[2])
+    elif op == "D": g.resolve_day()
+    elif op == "N": g.resolve_night()
+    elif op == "r": g.assign_roles(parse_deck(ev[1]))
+    else: raise ValueError(f"unknown event {ev!r}")
+
+def replay(gid: GameId, events: Iterable, record: bool = False) -> Game:
+    # a fresh Game with every entry applied in order. The log must start at the game's "g" entry
+    events = iter(events)
+    head = next(events, None)
+    if head is None or head[0] != "g":
+        raise ValueError(f"log for {gid} does not start at game creation")
+    g = Game(chat_id=gid[0], thread_id=gid[1], gid=gid[2], seed=head[1])
+    if record:
+        start(g)
+    for ev in events:
+        apply(g, ev)
+    return g
+
+def engine_state(g: Game) -> dict:
+    # to_state() without what the bot sets around the engine, host, preset, clocks and message ids
+    st = g.to_state()
+    for k in ("h", "ps", "la", "dl", "ui"):
+        st.pop(k, None)
+    return st
+
+# --- files ---
+def dump_line(gid: GameId, events: List[tuple]) -> str:
+    return json.dumps([gid[0], gid[1], gid[2], events], separators=(",", ":"), ensure_ascii=False) + "\n"
+
+def read_logs(paths: Iterable[str]) -> Dict[GameId, List[list]]:
+    # game -> all its entries, in file order, games in the order they first appear
+    games: Dict[GameId, List[list]] = {}
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                c, t, gid, evs = json.loads(line)
+                games.setdefault((c, t, gid), []).extend(evs)
+    return games
+
+class EventLog:
+    # append-only file writer. take() moves a game's new entries to pending on the loop, write() appends a
+    # batch of lines to the file and blocks, the bot runs it in a thread. Past max_bytes the file moves to
+    # path.1, older ones shift up to path.<backups> and the oldest is dropped, 0 never rotates
+    def __init__(self, path: str, max_bytes: int = 0, backups: int = 5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.pending: List[str] = []
+
+    def files(self) -> List[str]:
+        # the log and its rotated files that exist, oldest first, the order read_logs needs
+        paths = [f"{self.path}.{i}" for i in range(self.backups, 0, -1)] + [self.path]
+        return [p for p in paths if os.path.exists(p)]
+
+    def rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def take(self, g: Game):
+        if g.events:
+            self.pending.append(dump_line((g.chat_id, g.thread_id, g.gid), g.events))
+            g.events = []
+
+    def write(self, lines: List[str]):
+        if self.max_bytes and os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+            self.rotate()
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.writelines(lines)
@@ -7,7 +7,8 @@ class Alignment(Enum):
     WOLF = auto()
     NEUTRAL = auto()
 
-@dataclass(frozen=True)
+# roles are singletons, eq=False makes == and hashing identity based, no field compare or tuple hash
+@dataclass(frozen=True, eq=False, slots=True)
 class Role:
     name: str
     alignment: Alignment
@@ -64,3 +65,6 @@ ALL_ROLES = [
     TANNER, TOUGH_GUY, TROUBLEMAKER, VAMPIRE, VILLAGE_IDIOT,
     VILLAGER, WEREWOLF, WITCH, WOLF_CUB
 ]
+
+# name -> Role, covers every Role defined above, used to load saved games and role lists
+ROLES_BY_NAME = {r.name: r for r in list(globals().values()) if isinstance(r, Role)}
@@ -0,0 +1,97 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+import random, time
+from .game import Game
+from .roles import Role, ALL_ROLES
+
+# Headless driver, plays whole games through the public Game methods with seeded random agents.
+# No Telegram involved, used by the engine benchmarks and the deck balancer.
+
+@dataclass
+class SimResult:
+    days: int
+    alive: int
+    wolves_alive: int
+    game: Game
+    winner: Optional[str] = None  # faction, "draw", or None when max_days ran out
+    day_times: List[float] = field(default_factory=list)    # seconds per resolve_day
+    night_times: List[float] = field(default_factory=list)  # seconds per resolve_night
+
+def recount(votes: Dict[int, object]):
+    # from-scratch tally, the reference the incremental Tally is checked against
+    counts = {}
+    for t in votes.values():
+        counts[t] = counts.get(t, 0) + 1
+    if not counts: return None, True
+    mx = max(counts.values())
+    top = [t for t, n in counts.items() if n == mx]
+    if len(top) > 1 or top[0] == "skip": return None, True
+    return int(top[0]), False
+
+def wolves_alive(g: Game) -> int:
+    return sum(1 for u in g.wolves if u in g.alive_set)
+
+def default_over(g: Game) -> bool:
+    return g.phase == "end"
+
+def recount_teams(g: Game) -> Dict[str, int]:
+    # from-scratch faction count, the reference the incremental counters are checked against
+    counts = dict.fromkeys(g.team_alive, 0)
+    for uid in g.alive_set:
+        counts[g.faction(uid)] += 1
+    return counts
+
+def simulate(n_players: int, deck: List[Role] = ALL_ROLES, seed: int = 0, max_days: int = 30,
+             skip_rate: float = 0.1, revote_rate: float = 0.2, check: bool = False, timed: bool = False,
+             over: Callable[[Game], bool] = default_over, record: bool = False) -> SimResult:
+    # the agents draw from rng, the deal from the game's own seed, so a seed replays the same game.
+    # record keeps the game's event log in res.game.events
+    rng = random.Random(seed)
+    g = Game(chat_id=-seed - 1, seed=seed)
+    if record:
+        g.events = [("g", seed)]
+    for i in range(n_players):
+        g.add_player(1000 + i, f"p{i}")
+    g.assign_roles(deck)
+    res = SimResult(0, 0, 0, g)
+    clock = time.perf_counter
+    while not over(g) and g.day <= max_days:
+        # day, everyone votes, some change their mind
+        alive = g.alive_list()
+        voters = list(alive)
+        voters += rng.sample(voters, int(len(voters) * revote_rate))
+        for v in voters:
+            target = "skip" if rng.random() < skip_rate else rng.choice(alive)
+            g.vote(v, target)
+            if check:
+                assert g.tally() == recount(g.votes), (g.tally(), recount(g.votes))
+        if check:
+            assert g.waiting_on() == 0, g.waiting_on()
+        t = clock() if timed else 0
+        g.resolve_day()
+        if timed: res.day_times.append(clock() - t)
+        if check:
+            assert g.team_alive == recount_teams(g), (g.team_alive, recount_teams(g))
+        if over(g): break
+        # night, every actor uses every action it has
+        alive = g.alive_list()
+        for uid, code in list(g.night_actors()):
+            g.act(code, uid, rng.choice(alive))
+            if check and code == "kill":
+                top = set(g.wolf_tally.leaders())
+                counts = {}
+                for t in g.wolf_votes.values(): counts[t] = counts.get(t, 0) + 1
+                assert top == {t for t, n in counts.items() if n == max(counts.values())}
+        if check:
+            assert g.waiting_on() == 0, g.night_pending
+        t = clock() if timed else 0
+        g.resolve_night()
+        if timed: res.night_times.append(clock() - t)
+        if check:
+            assert g.team_alive == recount_teams(g), (g.team_alive, recount_teams(g))
+    res.days = g.day
+    res.alive = len(g.alive_set)
+    res.wolves_alive = wolves_alive(g)
+    res.winner = g.winner
+    return res
@@ -0,0 +1,67 @@
+from typing import Dict, Hashable, Optional, Tuple
+
+class Tally:
+    # running vote counter, every add/remove is O(1) and so is reading the leader.
+    # by_count maps a count to the targets holding it, dicts keep the order targets reached it
+    __slots__ = ("counts", "by_count", "top")
+
+    def __init__(self):
+        self.counts: Dict[Hashable, int] = {}
+        self.by_count: Dict[int, Dict[Hashable, None]] = {}
+        self.top = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def _move(self, target, old: int, new: int):
+        if old:
+            bucket = self.by_count[old]
+            del bucket[target]
+            if not bucket:
+                del self.by_count[old]
+        if new:
+            self.by_count.setdefault(new, {})[target] = None
+            self.counts[target] = new
+        else:
+            del self.counts[target]
+
+    def add(self, target):
+        old = self.counts.get(target, 0)
+        self._move(target, old, old + 1)
+        if old + 1 > self.top:
+            self.top = old + 1
+
+    def remove(self, target):
+        old = self.counts[target]
+        self._move(target, old, old - 1)
+        # the target that left the top still holds old-1, so the next level is never empty
+        if old == self.top and old not in self.by_count:
+            self.top = old - 1
+
+    def change(self, old, new):
+        if old is not None:
+            self.remove(old)
+        self.add(new)
+
+    def clear(self):
+        self.counts.clear()
+        self.by_count.clear()
+        self.top = 0
+
+    def leaders(self):
+        return list(self.by_count.get(self.top, ()))
+
+    def leader(self) -> Tuple[Optional[Hashable], bool]:
+        # returns, the single top target or None, and whether there is a tie or no votes
+        if not self.top:
+            return None, True
+        bucket = self.by_count[self.top]
+        if len(bucket) > 1:
+            return None, True
+        return next(iter(bucket)), False
+
+    def plurality(self) -> Optional[Hashable]:
+        # top target, ties go to whoever reached the top count first
+        if not self.top:
+            return None
+        return next(iter(self.by_count[self.top]))
@@ -0,0 +1,29 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, Hashable
+
+# one asyncio.Lock per key, created on demand and dropped once nobody holds or waits on it
+class KeyedLocks:
+    def __init__(self):
+        self.locks: Dict[Hashable, asyncio.Lock] = {}
+        self.refs: Dict[Hashable, int] = {}
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable):
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = self.locks[key] = asyncio.Lock()
+        self.refs[key] = self.refs.get(key, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            n = self.refs[key] - 1
+            if n:
+                self.refs[key] = n
+            else:
+                del self.refs[key]
+                del self.locks[key]
+
+    def __len__(self):
+        return len(self.locks)
@@ -0,0 +1,144 @@
+import functools, logging, time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from telegram.request import BaseRequest
+import tornado.web
+
+log = logging.getLogger("werewolf-bot.metrics")
+
+# seconds, handler and Bot API latency
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    # fixed buckets, observe() is one bisect and two adds, cumulative counts are only built on render
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, v: float):
+        self.counts[bisect_left(self.bounds, v)] += 1
+        self.sum += v
+        self.count += 1
+
+    def lines(self, name: str, labels: str) -> Iterable[str]:
+        sep = "," if labels else ""
+        acc = 0
+        for le, n in zip(self.bounds, self.counts):
+            acc += n
+            yield f'{name}_bucket{{{labels}{sep}le="{le}"}} {acc}'
+        yield f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}'
+        yield f"{name}_sum{{{labels}}} {self.sum}"
+        yield f"{name}_count{{{labels}}} {self.count}"
+
+def _esc(v) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Registry:
+    # handler and Bot API series, plus collectors called on scrape for gauges that are cheaper to read than to track
+    def __init__(self):
+        self.handler_seconds: Dict[str, Histogram] = {}
+        self.handler_errors: Dict[str, int] = {}
+        self.api_seconds: Dict[str, Histogram] = {}
+        self.api_errors: Dict[str, int] = {}
+        self.collectors: List[Callable[[], Iterable[str]]] = []
+
+    def instrument(self, name: str, fn):
+        # wraps an update handler, time and errors are recorded under name
+        hist = self.handler_seconds.setdefault(name, Histogram())
+        errors = self.handler_errors
+        errors.setdefault(name, 0)
+        clock = time.perf_counter
+
+        @functools.wraps(fn)
+        async def wrapper(update, ctx):
+            t = clock()
+            try:
+                return await fn(update, ctx)
+            except Exception:
+                errors[name] += 1
+                raise
+            finally:
+                hist.observe(clock() - t)
+        return wrapper
+
+    def api_call(self, method: str, seconds: float, ok: bool):
+        hist = self.api_seconds.get(method)
+        if hist is None:
+            hist = self.api_seconds[method] = Histogram()
+            self.api_errors[method] = 0
+        hist.observe(seconds)
+        if not ok:
+            self.api_errors[method] += 1
+
+    def render(self) -> str:
+        out = [
+            "# HELP werewolf_handler_seconds Update handler latency, lock wait included.",
+            "# TYPE werewolf_handler_seconds histogram",
+        ]
+        for name, h in sorted(self.handler_seconds.items()):
+            out.extend(h.lines("werewolf_handler_seconds", f'handler="{_esc(name)}"'))
+        out += ["# HELP werewolf_handler_errors_total Handler calls that raised.", "# TYPE werewolf_handler_errors_total counter"]
+        out += [f'werewolf_handler_errors_total{{handler="{_esc(n)}"}} {v}' for n, v in sorted(self.handler_errors.items())]
+        out += ["# HELP werewolf_api_seconds Bot API call latency by method.", "# TYPE werewolf_api_seconds histogram"]
+        for name, h in sorted(self.api_seconds.items()):
+            out.extend(h.lines("werewolf_api_seconds", f'method="{_esc(name)}"'))
+        out += ["# HELP werewolf_api_calls_total Bot API calls by method.", "# TYPE werewolf_api_calls_total counter"]
+        out += [f'werewolf_api_calls_total{{method="{_esc(n)}"}} {h.count}' for n, h in sorted(self.api_seconds.items())]
+        out += ["# HELP werewolf_api_errors_total Bot API calls that failed or got a non-2xx answer.", "# TYPE werewolf_api_errors_total counter"]
+        out += [f'werewolf_api_errors_total{{method="{_esc(n)}"}} {v}' for n, v in sorted(self.api_errors.items())]
+        for collect in self.collectors:
+            try:
+                out.extend(collect())
+            except Exception:
+                log.exception("metrics collector failed")
+        return "\n".join(out) + "\n"
+
+def gauge(name: str, help: str, samples: Iterable[Tuple[Dict[str, object], float]]) -> List[str]:
+    out = [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+    for labels, v in samples:
+        lab = ",".join(f'{k}="{_esc(x)}"' for k, x in labels.items())
+        out.append(f"{name}{{{lab}}} {v}" if lab else f"{name} {v}")
+    return out
+
+class MeteredRequest(BaseRequest):
+    # wraps the Bot API transport, every call is counted and timed by method name
+    def __init__(self, inner: BaseRequest, registry: Registry):
+        self.inner = inner
+        self.registry = registry
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return self.inner.read_timeout
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        name = url.rsplit("/", 1)[-1]
+        t = time.perf_counter()
+        ok = False
+        try:
+            code, payload = await self.inner.do_request(url, method, request_data, read_timeout=read_timeout,
+                                                        write_timeout=write_timeout, connect_timeout=connect_timeout,
+                                                        pool_timeout=pool_timeout)
+            ok = 200 <= code < 300
+            return code, payload
+        finally:
+            self.registry.api_call(name, time.perf_counter() - t, ok)
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def initialize(self, registry: Registry):
+        self.registry = registry
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(self.registry.render())
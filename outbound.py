@@ -0,0 +1,305 @@
+import asyncio, contextvars, heapq, itertools, logging, os, time
+from collections import OrderedDict, deque
+from typing import Dict, Iterable, List, Optional, Tuple
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+log = logging.getLogger("werewolf-bot.outbound")
+
+# Telegram limits, about 30 msg/s per bot, about 1 msg/s per private chat with short bursts and
+# about 20 msg/min per group
+GLOBAL_RATE = 30
+PER_CHAT_RATE = 1.0
+PER_CHAT_BURST = 3
+GROUP_RATE = 20 / 60
+GROUP_BURST = 3
+MAX_RETRIES = 3
+# first backoff after a network error, doubles on every retry
+BACKOFF = 0.5
+# plain texts queued for the same chat within this many seconds go out as one message
+MERGE_WINDOW = float(os.getenv("OUT_MERGE_WINDOW", "0.05"))
+MAX_TEXT = 4096
+
+# priority classes, lower goes first. PROMPT for role DMs and night prompts, PHASE for phase results
+# and vote panels, CHAT for command replies and the rest
+PROMPT, PHASE, CHAT = 0, 1, 2
+PRIOS = (PROMPT, PHASE, CHAT)
+PRIO_NAMES = ("prompt", "phase", "chat")
+
+# one message, chat_id, text, extra send_message kwargs
+Msg = Tuple[int, str, dict]
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.t = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.t) * self.rate)
+        self.t = now
+
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.burst
+
+    def wait(self) -> float:
+        # seconds until a token is free, 0 when one is free now
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class _Item:
+    __slots__ = ("bot", "text", "kw", "prio", "seq", "t", "fut", "tries", "ctx")
+
+    def __init__(self, bot, text, kw, prio, seq, fut):
+        self.bot, self.text, self.kw, self.prio, self.seq, self.fut = bot, text, kw, prio, seq, fut
+        self.t = time.monotonic()
+        self.tries = 0
+        # the sender's context, the send runs in it so request-scoped context vars still apply
+        self.ctx = contextvars.copy_context()
+
+    def mergeable(self) -> bool:
+        return "reply_markup" not in self.kw and "message_id" not in self.kw
+
+class _Chat:
+    __slots__ = ("queues", "bucket", "busy", "queued", "until")
+
+    def __init__(self, bucket: TokenBucket):
+        self.queues = tuple(deque() for _ in PRIOS)  # one FIFO per priority class
+        self.bucket = bucket
+        self.busy = False    # a send is in flight, keeps the chat's messages in order
+        self.queued = False  # sitting in the ready or later heap
+        self.until = 0.0     # flood-control backoff, monotonic
+
+    def head(self) -> Optional[_Item]:
+        for q in self.queues:
+            if q:
+                return q[0]
+        return None
+
+# every outgoing message goes through one queue. Each chat has a FIFO per priority class, a dispatcher
+# task picks the chat whose head message has the best priority and is oldest, under the global and
+# per-chat token buckets. One send per chat is in flight at a time, different chats send concurrently
+class OutboundQueue:
+    def __init__(self, global_rate: float = GLOBAL_RATE, per_chat_rate: float = PER_CHAT_RATE,
+                 per_chat_burst: float = PER_CHAT_BURST, retries: int = MAX_RETRIES, merge_window: float = MERGE_WINDOW,
+                 group_rate: float = GROUP_RATE, group_burst: float = GROUP_BURST):
+        self.bucket = TokenBucket(global_rate, global_rate)
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        # group and supergroup chat ids are negative
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.retries = retries
+        self.merge_window = merge_window
+        self.chats: Dict[int, _Chat] = {}
+        # chats with nothing queued or in flight, in the order they went idle, dropped once their bucket is full
+        self.idle: "OrderedDict[int, _Chat]" = OrderedDict()
+        self.ready: List[Tuple[int, int, int]] = []    # (prio, seq, chat_id), may go now
+        self.later: List[Tuple[float, int, int]] = []  # (monotonic, seq, chat_id), waiting on bucket, backoff or merge window
+        self.seq = itertools.count()
+        self.inflight = 0
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        # stats
+        self.depth = [0] * len(PRIOS)
+        self.waits = [deque(maxlen=2048) for _ in PRIOS]  # seconds from put to send, recent messages
+        self.sent = self.merged = self.retried = self.failed = 0
+
+    # --- public ---
+    def put(self, bot, chat_id: int, text: str, prio: int = CHAT, **kw) -> asyncio.Future:
+        # queue one message, the future resolves to the sent Message or None when it could not be delivered.
+        # callers that do not need the Message can drop it
+        self._ensure_running()
+        fut = asyncio.get_running_loop().create_future()
+        c = self.chats.get(chat_id)
+        if c is None:
+            self._forget_idle()
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+            c = self.chats[chat_id] = _Chat(bucket)
+        else:
+            self.idle.pop(chat_id, None)
+        c.queues[prio].append(_Item(bot, text, kw, prio, next(self.seq), fut))
+        self.depth[prio] += 1
+        if not c.busy and not c.queued:
+            self._make_ready(chat_id, c)
+        return fut
+
+    def edit(self, bot, chat_id: int, message_id: int, text: str, prio: int = PHASE, **kw) -> asyncio.Future:
+        # queued edit_message_text, edits count against the same chat limits as sends
+        return self.put(bot, chat_id, text, prio, message_id=message_id, **kw)
+
+    async def send(self, bot, chat_id: int, text: str, prio: int = CHAT, **kw):
+        # returns the sent Message, None on failure
+        return await self.put(bot, chat_id, text, prio, **kw)
+
+    async def send_many(self, bot, msgs: Iterable[Msg], prio: int = PROMPT) -> List[int]:
+        # returns the chat ids that did not get every message
+        futs = [(m[0], self.put(bot, m[0], m[1], prio, **m[2])) for m in msgs]
+        results = await asyncio.gather(*(f for _, f in futs))
+        return list(dict.fromkeys(c for (c, _), r in zip(futs, results) if r is None))
+
+    def stats(self) -> dict:
+        out = {"depth": sum(self.depth), "chats": len(self.chats), "inflight": self.inflight,
+               "sent": self.sent, "merged": self.merged, "retried": self.retried, "failed": self.failed}
+        for p in PRIOS:
+            w = sorted(self.waits[p])
+            name = PRIO_NAMES[p]
+            out[f"depth_{name}"] = self.depth[p]
+            out[f"wait_{name}_p50"] = w[len(w) // 2] if w else 0.0
+            out[f"wait_{name}_p99"] = w[min(len(w) - 1, int(len(w) * 0.99))] if w else 0.0
+        return out
+
+    async def drain(self, timeout: float = 10.0):
+        # wait for queued messages to go out, then stop the dispatcher
+        t = time.monotonic()
+        while (sum(self.depth) or self.inflight) and time.monotonic() - t < timeout:
+            await asyncio.sleep(0.02)
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    # --- dispatcher ---
+    def _ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._wake = asyncio.Event()
+            self._task = loop.create_task(self._run())
+
+    def _make_ready(self, chat_id: int, c: _Chat):
+        head = c.head()
+        if head is None:
+            return
+        c.queued = True
+        heapq.heappush(self.ready, (head.prio, head.seq, chat_id))
+        self._wake.set()
+
+    def _defer(self, chat_id: int, when: float):
+        heapq.heappush(self.later, (when, next(self.seq), chat_id))
+
+    def _forget_idle(self):
+        # a chat with nothing queued and a full bucket carries no state. Oldest idle first, stops at the first
+        # bucket still refilling, so each chat is looked at about once per time it goes idle
+        idle = self.idle
+        while idle:
+            cid, c = next(iter(idle.items()))
+            if not c.bucket.full():
+                break
+            del idle[cid]
+            del self.chats[cid]
+
+    async def _sleep(self, timeout: Optional[float]):
+        self._wake.clear()
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self):
+        ready, later = self.ready, self.later
+        while True:
+            now = time.monotonic()
+            while later and later[0][0] <= now:
+                _, _, cid = heapq.heappop(later)
+                c = self.chats.get(cid)
+                if c is not None:
+                    c.queued = False
+                    self._make_ready(cid, c)
+            if not ready:
+                await self._sleep(later[0][0] - now if later else None)
+                continue
+            gwait = self.bucket.wait()
+            if gwait:
+                await asyncio.sleep(gwait)
+                continue
+            _, _, cid = heapq.heappop(ready)
+            c = self.chats[cid]
+            head = c.head()
+            if head is None:
+                c.queued = False
+                continue
+            # hold back for the backoff, the chat's own bucket, or more text to merge with
+            hold = max(c.until, head.t + self.merge_window if head.mergeable() else 0.0) - now
+            hold = max(hold, c.bucket.wait())
+            if hold > 0:
+                self._defer(cid, now + hold)
+                continue
+            c.queued = False
+            self.bucket.take(); c.bucket.take()
+            batch = self._take_batch(c, now)
+            c.busy = True
+            self.inflight += 1
+            asyncio.get_running_loop().create_task(self._send(cid, c, batch), context=batch[0].ctx)
+
+    def _take_batch(self, c: _Chat, now: float) -> List[_Item]:
+        q = c.queues[c.head().prio]
+        first = q.popleft()
+        batch = [first]
+        if first.mergeable():
+            size = len(first.text)
+            while q and q[0].mergeable() and q[0].kw == first.kw and size + 1 + len(q[0].text) <= MAX_TEXT:
+                size += 1 + len(q[0].text)
+                batch.append(q.popleft())
+        self.depth[first.prio] -= len(batch)
+        waits = self.waits[first.prio]
+        for it in batch:
+            waits.append(now - it.t)
+        return batch
+
+    async def _send(self, cid: int, c: _Chat, batch: List[_Item]):
+        first = batch[0]
+        text = "\n".join(it.text for it in batch) if len(batch) > 1 else first.text
+        result, retry_in = None, 0.0
+        try:
+            if "message_id" in first.kw:
+                result = await first.bot.edit_message_text(chat_id=cid, text=text, **first.kw)
+            else:
+                result = await first.bot.send_message(chat_id=cid, text=text, **first.kw)
+        except RetryAfter as e:
+            retry_in = float(e.retry_after)
+        except Forbidden:
+            # user never opened the DM or blocked the bot
+            pass
+        except BadRequest as e:
+            # an edit that changes nothing is rejected too, not worth a warning
+            if "not modified" not in str(e):
+                log.warning("send_message to %s rejected, %s", cid, e)
+        except TimedOut:
+            # no answer in time, Telegram has most likely taken the message, a retry would post it twice
+            log.warning("send_message to %s timed out, not retried", cid)
+        except NetworkError as e:
+            retry_in = BACKOFF * 2 ** first.tries
+            log.info("send_message to %s failed, %s, retrying in %.1fs", cid, e, retry_in)
+        except Exception:
+            log.exception("send_message to %s failed", cid)
+        self.inflight -= 1
+        c.busy = False
+        if retry_in and first.tries < self.retries:
+            # back to the front of its class, in the same order
+            first.tries += 1
+            self.retried += 1
+            q = c.queues[first.prio]
+            for it in reversed(batch):
+                q.appendleft(it)
+            self.depth[first.prio] += len(batch)
+            c.until = time.monotonic() + retry_in
+        else:
+            if result is None:
+                self.failed += len(batch)
+            else:
+                self.sent += 1
+                self.merged += len(batch) - 1
+            for it in batch:
+                if not it.fut.done():
+                    it.fut.set_result(result)
+        if c.head() is None:
+            self.idle[cid] = c
+        elif not c.queued:
+            self._make_ready(cid, c)
@@ -0,0 +1,77 @@
+import asyncio, heapq, itertools, logging, time
+from typing import Awaitable, Callable, Dict, Hashable, List, Tuple
+
+log = logging.getLogger("werewolf-bot.scheduler")
+
+# one heap and one task for every game's phase deadline. Entries are never removed from the middle,
+# a reschedule pushes a new entry and the old one is skipped when it surfaces (lazy deletion).
+class PhaseScheduler:
+    def __init__(self, on_due: Callable[[Hashable], Awaitable[None]], clock: Callable[[], float] = time.time):
+        self.on_due = on_due
+        self.clock = clock
+        self.heap: List[Tuple[float, int, Hashable]] = []
+        self.deadlines: Dict[Hashable, float] = {}
+        self.seq = itertools.count()
+        self._wake = asyncio.Event()
+        self._task = None
+        self.fired = 0
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def schedule(self, key: Hashable, when: float):
+        self.deadlines[key] = when
+        if not self.heap or when < self.heap[0][0]:
+            # new earliest deadline, the sleeper has to wake up sooner
+            self._wake.set()
+        heapq.heappush(self.heap, (when, next(self.seq), key))
+        if len(self.heap) > 2 * len(self.deadlines) + 1024:
+            self._compact()
+
+    def cancel(self, key: Hashable):
+        self.deadlines.pop(key, None)
+
+    def _compact(self):
+        self.heap = [(w, next(self.seq), k) for k, w in self.deadlines.items()]
+        heapq.heapify(self.heap)
+
+    def _pop_due(self, now: float) -> List[Hashable]:
+        due = []
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            when, _, key = heapq.heappop(heap)
+            if self.deadlines.get(key) == when:
+                del self.deadlines[key]
+                due.append(key)
+        return due
+
+    async def run(self):
+        while True:
+            self._wake.clear()
+            now = self.clock()
+            for key in self._pop_due(now):
+                self.fired += 1
+                asyncio.create_task(self._fire(key))
+            # drop stale heads so the sleep targets a live deadline
+            while self.heap and self.deadlines.get(self.heap[0][2]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            timeout = self.heap[0][0] - self.clock() if self.heap else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, key: Hashable):
+        try:
+            await self.on_due(key)
+        except Exception:
+            log.exception("phase deadline for %s failed", key)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,189 @@
+# sharded deployment, a front dispatcher owns PORT and hands every update to one of N bot workers
+#   python shard.py [workers]      or SHARDS=4 python shard.py
+# workers are bot.py processes on WORKER_PORT_BASE + i (default PORT + 1 + i), each owns the games that
+# hash to it on a consistent-hash ring. With WEBHOOK_URL the dispatcher takes Telegram's webhook, without
+# it the dispatcher polls and forwards, so the whole thing runs locally. Use GAME_STORE=sqlite with one
+# GAME_DB for all workers, after a resize moved games load from there on their new owner
+import asyncio, hashlib, json, logging, os, signal, subprocess, sys
+from bisect import bisect
+from typing import Hashable, List, Optional, Sequence
+
+log = logging.getLogger("werewolf-bot.shard")
+
+VNODES = 160  # ring points per worker, more points even out the slices
+
+def _h(s: str) -> int:
+    return int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big")
+
+class HashRing:
+    def __init__(self, nodes: Sequence[Hashable], vnodes: int = VNODES):
+        points = sorted((_h(f"{n}#{i}"), n) for n in nodes for i in range(vnodes))
+        self.hashes = [p for p, _ in points]
+        self.nodes = [n for _, n in points]
+
+    def node_for(self, key: str):
+        i = bisect(self.hashes, _h(key))
+        return self.nodes[i % len(self.nodes)]
+
+def game_key(chat_id: int, thread_id: int) -> str:
+    return f"{chat_id}:{thread_id}"
+
+def user_key(uid: int) -> str:
+    return f"u{uid}"
+
+# --- routing, on the raw update json, mirrors bot.key_of and bot.dm_key ---
+BROADCAST = None
+
+def route_key(u: dict) -> Optional[str]:
+    # ring key for an update, BROADCAST (None) for updates every worker needs
+    if "my_chat_member" in u or "chat_member" in u:
+        # admin lists are cached per worker
+        return BROADCAST
+    q = u.get("callback_query")
+    if q is not None:
+        msg = q.get("message") or {}
+        chat = msg.get("chat") or {}
+        if chat.get("type") == "private" or not chat:
+            # night buttons name their game, see bot.button_data
+            parts = (q.get("data") or "").split(":")
+            if len(parts) == 6:
+                try:
+                    return game_key(int(parts[4], 16), int(parts[5], 16))
+                except ValueError:
+                    pass
+            return user_key(q["from"]["id"])
+        return game_key(chat["id"], msg.get("message_thread_id") or 0)
+    for field in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        msg = u.get(field)
+        if msg is None:
+            continue
+        chat = msg["chat"]
+        if chat.get("type") == "private":
+            # /start role_<chat>_<thread> deep links belong to that game
+            text = msg.get("text") or ""
+            if text.startswith("/start role_"):
+                try:
+                    _, c, t = text.split(maxsplit=1)[1].split("_", 2)
+                    return game_key(int(c), int(t))
+                except ValueError:
+                    pass
+            return user_key(chat["id"])
+        return game_key(chat["id"], msg.get("message_thread_id") or 0)
+    for v in u.values():
+        if isinstance(v, dict) and isinstance(v.get("from"), dict):
+            return user_key(v["from"]["id"])
+    return user_key(0)
+
+# --- dispatcher ---
+class Dispatcher:
+    def __init__(self, workers: List[str]):
+        from tornado.httpclient import AsyncHTTPClient
+        self.workers = workers  # base urls, http://127.0.0.1:port
+        self.ring = HashRing(range(len(workers)))
+        self.http = AsyncHTTPClient(max_clients=256)
+        self.forwarded = [0] * len(workers)
+        self.failed = [0] * len(workers)
+
+    async def _post(self, i: int, body: bytes) -> bool:
+        try:
+            await self.http.fetch(self.workers[i] + "/webhook", method="POST", body=body,
+                                  headers={"Content-Type": "application/json"}, request_timeout=30)
+            self.forwarded[i] += 1
+            return True
+        except Exception as e:
+            self.failed[i] += 1
+            log.warning("forward to worker %d failed, %s", i, e)
+            return False
+
+    async def forward(self, u: dict, body: Optional[bytes] = None) -> bool:
+        body = body or json.dumps(u).encode()
+        k = route_key(u)
+        if k is BROADCAST:
+            return all(await asyncio.gather(*(self._post(i, body) for i in range(len(self.workers)))))
+        return await self._post(self.ring.node_for(k), body)
+
+    def render(self) -> str:
+        out = ["# HELP werewolf_shard_forwarded_total Updates handed to each worker.", "# TYPE werewolf_shard_forwarded_total counter"]
+        out += [f'werewolf_shard_forwarded_total{{worker="{i}"}} {n}' for i, n in enumerate(self.forwarded)]
+        out += ["# HELP werewolf_shard_failed_total Updates a worker did not take.", "# TYPE werewolf_shard_failed_total counter"]
+        out += [f'werewolf_shard_failed_total{{worker="{i}"}} {n}' for i, n in enumerate(self.failed)]
+        return "\n".join(out) + "\n"
+
+def spawn_workers(n: int, base_port: int) -> List[subprocess.Popen]:
+    here = os.path.dirname(os.path.abspath(__file__))
+    procs = []
+    for i in range(n):
+        env = dict(os.environ, PORT=str(base_port + i), SHARD_INDEX=str(i), SHARD_COUNT=str(n))
+        procs.append(subprocess.Popen([sys.executable, os.path.join(here, "bot.py")], env=env))
+    return procs
+
+async def poll(dispatcher: Dispatcher, token: str, stop: asyncio.Event):
+    # local mode, long-poll Telegram and forward, offsets only move past updates a worker took
+    from telegram import Bot
+    async with Bot(token) as bot:
+        await bot.delete_webhook()
+        offset = 0
+        while not stop.is_set():
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=20, allowed_updates=["message", "edited_message", "callback_query", "my_chat_member", "chat_member"])
+            except Exception as e:
+                log.warning("getUpdates failed, %s", e)
+                await asyncio.sleep(1)
+                continue
+            for up in updates:
+                if not await dispatcher.forward(up.to_dict()):
+                    await asyncio.sleep(1)
+                    break
+                offset = up.update_id + 1
+
+async def serve(n: int):
+    import tornado.web
+    port = int(os.getenv("PORT", "10000"))
+    base = int(os.getenv("WORKER_PORT_BASE", str(port + 1)))
+    token = os.getenv("BOT_TOKEN") or os.getenv("TELEGRAM_BOT_TOKEN") or os.getenv("TELEGRAM_TOKEN") or os.getenv("TOKEN") or ""
+    webhook_url = os.getenv("WEBHOOK_URL", "")
+    procs = spawn_workers(n, base)
+    d = Dispatcher([f"http://127.0.0.1:{base + i}" for i in range(n)])
+
+    class Webhook(tornado.web.RequestHandler):
+        async def post(self):
+            try:
+                u = json.loads(self.request.body)
+            except ValueError:
+                self.set_status(400)
+                return
+            if not await d.forward(u, self.request.body):
+                # Telegram retries on an error status
+                self.set_status(503)
+
+    class Metrics(tornado.web.RequestHandler):
+        def get(self):
+            self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.write(d.render())
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    server = tornado.web.Application([(r"/webhook", Webhook), (r"/metrics", Metrics)]).listen(port, address="0.0.0.0")
+    log.info("dispatching to %d workers on ports %d-%d", n, base, base + n - 1)
+    if webhook_url:
+        from telegram import Bot
+        async with Bot(token) as bot:
+            await bot.set_webhook(f"{webhook_url}/webhook", allowed_updates=["message", "edited_message", "callback_query", "my_chat_member", "chat_member"])
+        await stop.wait()
+    else:
+        await poll(d, token, stop)
+    server.stop()
+    for p in procs:
+        p.send_signal(signal.SIGTERM)
+    for p in procs:
+        p.wait(timeout=30)
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else int(os.getenv("SHARDS", "2"))
+    asyncio.run(serve(n))
+
+if __name__ == "__main__":
+    main()
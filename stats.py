@@ -0,0 +1,194 @@
+import asyncio, json, logging, os, sqlite3, time
+from typing import Dict, List, Optional, Tuple
+from game.game import Game
+
+log = logging.getLogger("werewolf-bot.stats")
+
+# finished games, one row each in an append-only history, plus running totals per user, per user and chat,
+# per user and role, per role, per faction and per chat. Totals move by the game's deltas when it is
+# recorded, /stats is primary key lookups and /leaderboard an index walk, history is never scanned
+
+# one player of a finished game, uid, name, role, faction at the end, alive, lynched, won
+Seat = Tuple[int, str, str, str, bool, bool, bool]
+# chat_id, thread_id, ended (wall clock), days played, winner, seats
+Record = Tuple[int, int, float, int, str, List[Seat]]
+
+def game_record(g: Game) -> Record:
+    lynched = set(g.lynched)
+    seats = []
+    for uid in g.order:
+        ps = g.players[uid]
+        team = g.faction(uid)
+        seats.append((uid, ps.name, ps.role.name, team, ps.alive, uid in lynched, team == g.winner))
+    return (g.chat_id, g.thread_id, time.time(), g.day, g.winner or "draw", seats)
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY, chat_id INTEGER, thread_id INTEGER, ended REAL, days INTEGER, winner TEXT, seats TEXT)",
+    "CREATE TABLE IF NOT EXISTS users (uid INTEGER PRIMARY KEY, name TEXT, games INTEGER, wins INTEGER, survived INTEGER, lynched INTEGER)",
+    "CREATE INDEX IF NOT EXISTS users_rank ON users (wins DESC, games, uid)",
+    "CREATE TABLE IF NOT EXISTS chat_users (chat_id INTEGER, uid INTEGER, games INTEGER, wins INTEGER, survived INTEGER, lynched INTEGER, PRIMARY KEY (chat_id, uid)) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS chat_users_rank ON chat_users (chat_id, wins DESC, games, uid)",
+    "CREATE TABLE IF NOT EXISTS user_roles (uid INTEGER, role TEXT, games INTEGER, wins INTEGER, PRIMARY KEY (uid, role)) WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS roles (role TEXT PRIMARY KEY, games INTEGER, wins INTEGER, survived INTEGER) WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS teams (team TEXT PRIMARY KEY, games INTEGER, wins INTEGER) WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS chats (chat_id INTEGER PRIMARY KEY, games INTEGER, seats INTEGER, survived INTEGER, lynched INTEGER, days INTEGER)",
+    "CREATE TABLE IF NOT EXISTS chat_wins (chat_id INTEGER, team TEXT, wins INTEGER, PRIMARY KEY (chat_id, team)) WITHOUT ROWID",
+)
+
+def deltas(records: List[Record]):
+    # sums a batch per table first, a busy player or chat is one upsert per flush however many games it had
+    names: Dict[int, str] = {}
+    users: Dict[int, list] = {}
+    chat_users: Dict[Tuple[int,int], list] = {}
+    user_roles: Dict[Tuple[int,str], list] = {}
+    roles: Dict[str, list] = {}
+    teams: Dict[str, list] = {}
+    chats: Dict[int, list] = {}
+    chat_wins: Dict[Tuple[int,str], int] = {}
+    for chat_id, _, _, days, winner, seats in records:
+        alive = lyn = 0
+        for uid, name, role, team, a, ly, won in seats:
+            names[uid] = name
+            for d, k in ((users, uid), (chat_users, (chat_id, uid))):
+                v = d.get(k)
+                if v is None: d[k] = [1, won, a, ly]
+                else: v[0] += 1; v[1] += won; v[2] += a; v[3] += ly
+            v = user_roles.get((uid, role))
+            if v is None: user_roles[(uid, role)] = [1, won]
+            else: v[0] += 1; v[1] += won
+            v = roles.get(role)
+            if v is None: roles[role] = [1, won, a]
+            else: v[0] += 1; v[1] += won; v[2] += a
+            v = teams.get(team)
+            if v is None: teams[team] = [1, won]
+            else: v[0] += 1; v[1] += won
+            alive += a; lyn += ly
+        v = chats.get(chat_id)
+        if v is None: chats[chat_id] = [1, len(seats), alive, lyn, days]
+        else: v[0] += 1; v[1] += len(seats); v[2] += alive; v[3] += lyn; v[4] += days
+        chat_wins[(chat_id, winner)] = chat_wins.get((chat_id, winner), 0) + 1
+    return names, users, chat_users, user_roles, roles, teams, chats, chat_wins
+
+class StatsStore:
+    def __init__(self, path: str, interval: float = 2.0):
+        # writes come from the flusher thread, reads from the loop on their own connection, WAL lets them overlap.
+        # shard workers share one file, the timeout covers a neighbour's write
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        # totals are updated at random keys, a bigger page cache keeps their upper levels in memory
+        self.db.execute("PRAGMA cache_size=-65536")
+        for q in SCHEMA:
+            self.db.execute(q)
+        # ":memory:" is private to its connection, reads share the writer's there
+        self.rdb = self.db if path == ":memory:" else sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self.interval = interval
+        self.pending: List[Record] = []
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    # --- writes ---
+    def record(self, g: Game):
+        # built on the loop while the game is still whole, written on the next flush
+        self.pending.append(game_record(g))
+
+    def write(self, records: List[Record]):
+        # blocking, one transaction for the history rows and every total
+        names, users, chat_users, user_roles, roles, teams, chats, chat_wins = deltas(records)
+        db = self.db
+        with db:
+            db.execute("BEGIN")
+            db.executemany("INSERT INTO results (chat_id, thread_id, ended, days, winner, seats) VALUES (?,?,?,?,?,?)",
+                           [(c, t, e, d, w, json.dumps([s[:1] + s[2:] for s in seats], separators=(",", ":")))
+                            for c, t, e, d, w, seats in records])
+            db.executemany("INSERT INTO users VALUES (?,?,?,?,?,?) ON CONFLICT (uid) DO UPDATE SET name=excluded.name, "
+                           "games=games+excluded.games, wins=wins+excluded.wins, survived=survived+excluded.survived, lynched=lynched+excluded.lynched",
+                           [(uid, names[uid], *v) for uid, v in users.items()])
+            db.executemany("INSERT INTO chat_users VALUES (?,?,?,?,?,?) ON CONFLICT (chat_id, uid) DO UPDATE SET "
+                           "games=games+excluded.games, wins=wins+excluded.wins, survived=survived+excluded.survived, lynched=lynched+excluded.lynched",
+                           [(*k, *v) for k, v in chat_users.items()])
+            db.executemany("INSERT INTO user_roles VALUES (?,?,?,?) ON CONFLICT (uid, role) DO UPDATE SET "
+                           "games=games+excluded.games, wins=wins+excluded.wins",
+                           [(*k, *v) for k, v in user_roles.items()])
+            db.executemany("INSERT INTO roles VALUES (?,?,?,?) ON CONFLICT (role) DO UPDATE SET "
+                           "games=games+excluded.games, wins=wins+excluded.wins, survived=survived+excluded.survived",
+                           [(k, *v) for k, v in roles.items()])
+            db.executemany("INSERT INTO teams VALUES (?,?,?) ON CONFLICT (team) DO UPDATE SET "
+                           "games=games+excluded.games, wins=wins+excluded.wins",
+                           [(k, *v) for k, v in teams.items()])
+            db.executemany("INSERT INTO chats VALUES (?,?,?,?,?,?) ON CONFLICT (chat_id) DO UPDATE SET games=games+excluded.games, "
+                           "seats=seats+excluded.seats, survived=survived+excluded.survived, lynched=lynched+excluded.lynched, days=days+excluded.days",
+                           [(k, *v) for k, v in chats.items()])
+            db.executemany("INSERT INTO chat_wins VALUES (?,?,?) ON CONFLICT (chat_id, team) DO UPDATE SET wins=wins+excluded.wins",
+                           [(*k, v) for k, v in chat_wins.items()])
+
+    async def flush(self):
+        async with self._lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, []
+            try:
+                await asyncio.to_thread(self.write, batch)
+            except Exception:
+                log.exception("stats flush failed, %d games kept", len(batch))
+                self.pending[:0] = batch
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        if self.rdb is not self.db:
+            self.rdb.close()
+        self.db.close()
+
+    # --- reads, primary key lookups and index walks ---
+    def user(self, uid: int) -> Optional[dict]:
+        row = self.rdb.execute("SELECT name, games, wins, survived, lynched FROM users WHERE uid=?", (uid,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("name", "games", "wins", "survived", "lynched"), row))
+
+    def chat_user(self, chat_id: int, uid: int) -> Optional[dict]:
+        row = self.rdb.execute("SELECT games, wins, survived, lynched FROM chat_users WHERE chat_id=? AND uid=?", (chat_id, uid)).fetchone()
+        return dict(zip(("games", "wins", "survived", "lynched"), row)) if row else None
+
+    def user_roles(self, uid: int) -> List[Tuple[str, int, int]]:
+        # (role, games, wins), most played first, a player holds a handful of roles so the sort is small
+        rows = self.rdb.execute("SELECT role, games, wins FROM user_roles WHERE uid=?", (uid,)).fetchall()
+        return sorted(rows, key=lambda r: (-r[1], r[0]))
+
+    def chat(self, chat_id: int) -> Optional[dict]:
+        row = self.rdb.execute("SELECT games, seats, survived, lynched, days FROM chats WHERE chat_id=?", (chat_id,)).fetchone()
+        if row is None:
+            return None
+        out = dict(zip(("games", "seats", "survived", "lynched", "days"), row))
+        out["wins"] = dict(self.rdb.execute("SELECT team, wins FROM chat_wins WHERE chat_id=?", (chat_id,)).fetchall())
+        return out
+
+    def roles(self) -> List[Tuple[str, int, int, int]]:
+        return self.rdb.execute("SELECT role, games, wins, survived FROM roles ORDER BY games DESC").fetchall()
+
+    def teams(self) -> Dict[str, Tuple[int, int]]:
+        return {t: (n, w) for t, n, w in self.rdb.execute("SELECT team, games, wins FROM teams")}
+
+    def leaderboard(self, chat_id: Optional[int] = None, limit: int = 10) -> List[Tuple[int, str, int, int, int]]:
+        # (uid, name, games, wins, survived) by wins, fewer games first on a tie, reads limit index entries
+        if chat_id is None:
+            return self.rdb.execute("SELECT uid, name, games, wins, survived FROM users ORDER BY wins DESC, games, uid LIMIT ?", (limit,)).fetchall()
+        return self.rdb.execute("SELECT c.uid, u.name, c.games, c.wins, c.survived FROM chat_users c JOIN users u ON u.uid = c.uid "
+                                "WHERE c.chat_id=? ORDER BY c.wins DESC, c.games, c.uid LIMIT ?", (chat_id, limit)).fetchall()
+
+def stats_from_env() -> StatsStore:
+    # STATS_DB is the sqlite file, kept apart from GAME_DB so game state can be wiped without losing history
+    return StatsStore(os.getenv("STATS_DB", "stats.db"), float(os.getenv("STORE_FLUSH_INTERVAL", "2")))
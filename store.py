@@ -0,0 +1,238 @@
+import asyncio, json, logging, os, sqlite3, time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Set, Tuple
+from game.game import Game
+
+log = logging.getLogger("werewolf-bot.store")
+
+Key = Tuple[int,int]
+
+def dumps(g: Game) -> bytes:
+    return json.dumps(g.to_state(), separators=(",", ":"), ensure_ascii=False).encode()
+
+def loads(blob: bytes) -> Game:
+    return Game.from_state(json.loads(blob))
+
+# --- Backends, all calls are blocking and batch friendly ---
+class MemoryBackend:
+    persistent = False
+
+    def __init__(self):
+        self.games: Dict[Key, bytes] = {}
+        self.users: Dict[int, Key] = {}
+        # key -> uids saved with it, a delete only touches its own players
+        self.seated: Dict[Key, Set[int]] = {}
+
+    def load(self, k: Key) -> Optional[bytes]:
+        return self.games.get(k)
+
+    def key_for_user(self, uid: int) -> Optional[Key]:
+        return self.users.get(uid)
+
+    def save_many(self, games: Dict[Key, Tuple[bytes, Iterable[int], float]]):
+        for k, (blob, uids, _) in games.items():
+            self.games[k] = blob
+            seated = self.seated.setdefault(k, set())
+            for uid in uids:
+                old = self.users.get(uid)
+                if old is not None and old != k:
+                    # moved to another game, like the sqlite players row it is overwritten
+                    self.seated[old].discard(uid)
+                self.users[uid] = k
+                seated.add(uid)
+
+    def delete_many(self, keys: Iterable[Key]):
+        for k in keys:
+            self.games.pop(k, None)
+            for uid in self.seated.pop(k, ()):
+                if self.users.get(uid) == k:
+                    del self.users[uid]
+
+    def load_pinned(self) -> Set[int]:
+        return set()
+
+    def is_pinned(self, chat_id: int) -> bool:
+        return False
+
+    def save_pinned(self, chat_ids: Iterable[int]):
+        # nothing survives a restart here, the bounded HOWTO_PINNED in the bot is the only record
+        pass
+
+    def load_deadlines(self):
+        return []
+
+    def count(self) -> int:
+        return len(self.games)
+
+    def close(self):
+        pass
+
+class SQLiteBackend:
+    persistent = True
+
+    def __init__(self, path: str):
+        # writes come from the flusher thread, reads from the loop on their own connection, WAL lets them overlap
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS games (chat_id INTEGER, thread_id INTEGER, data BLOB, updated REAL, PRIMARY KEY (chat_id, thread_id)) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS players (uid INTEGER PRIMARY KEY, chat_id INTEGER, thread_id INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS pinned (chat_id INTEGER PRIMARY KEY)")
+        cols = {r[1] for r in self.db.execute("PRAGMA table_info(games)")}
+        if "deadline" not in cols:
+            # phase deadline, 0 when none, read back in one scan at startup
+            self.db.execute("ALTER TABLE games ADD COLUMN deadline REAL NOT NULL DEFAULT 0")
+        self.rdb = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+
+    def load(self, k: Key) -> Optional[bytes]:
+        row = self.rdb.execute("SELECT data FROM games WHERE chat_id=? AND thread_id=?", k).fetchone()
+        return row[0] if row else None
+
+    def key_for_user(self, uid: int) -> Optional[Key]:
+        row = self.rdb.execute("SELECT chat_id, thread_id FROM players WHERE uid=?", (uid,)).fetchone()
+        return tuple(row) if row else None
+
+    def save_many(self, games: Dict[Key, Tuple[bytes, Iterable[int], float]]):
+        now = time.time()
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany("INSERT OR REPLACE INTO games (chat_id, thread_id, data, updated, deadline) VALUES (?,?,?,?,?)",
+                                [(k[0], k[1], blob, now, dl) for k, (blob, _, dl) in games.items()])
+            self.db.executemany("INSERT OR REPLACE INTO players VALUES (?,?,?)",
+                                [(uid, k[0], k[1]) for k, (_, uids, _) in games.items() for uid in uids])
+
+    def delete_many(self, keys: Iterable[Key]):
+        keys = list(keys)
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany("DELETE FROM games WHERE chat_id=? AND thread_id=?", keys)
+            self.db.executemany("DELETE FROM players WHERE chat_id=? AND thread_id=?", keys)
+
+    def load_pinned(self) -> Set[int]:
+        return {r[0] for r in self.rdb.execute("SELECT chat_id FROM pinned")}
+
+    def is_pinned(self, chat_id: int) -> bool:
+        return self.rdb.execute("SELECT 1 FROM pinned WHERE chat_id=?", (chat_id,)).fetchone() is not None
+
+    def save_pinned(self, chat_ids: Iterable[int]):
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany("INSERT OR IGNORE INTO pinned VALUES (?)", [(c,) for c in chat_ids])
+
+    def load_deadlines(self):
+        return [((c, t), dl) for c, t, dl in self.rdb.execute("SELECT chat_id, thread_id, deadline FROM games WHERE deadline > 0")]
+
+    def count(self) -> int:
+        return self.rdb.execute("SELECT COUNT(*) FROM games").fetchone()[0]
+
+    def close(self):
+        self.rdb.close()
+        self.db.close()
+
+def backend_from_env():
+    # GAME_STORE, "memory" (default) or "sqlite", GAME_DB is the sqlite file
+    kind = os.getenv("GAME_STORE", "memory")
+    if kind == "sqlite":
+        return SQLiteBackend(os.getenv("GAME_DB", "games.db"))
+    return MemoryBackend()
+
+# write-behind layer, handlers only mark games dirty, a background task flushes them in batches
+class GameStore:
+    def __init__(self, backend, interval: float = 2.0, max_misses: int = 50000):
+        self.backend = backend
+        self.interval = interval
+        self.dirty: Dict[Key, Game] = {}
+        # the batch a flush is writing, not in the backend yet
+        self.writing: Dict[Key, Game] = {}
+        self.deleted: Set[Key] = set()
+        self.pinned_dirty: Set[int] = set()
+        # keys the backend had no game for, bounded, least recently missed go first and are read again
+        self.misses: "OrderedDict[Key, None]" = OrderedDict()
+        self.max_misses = max_misses
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    def touch(self, g: Game):
+        self.dirty[g.key] = g
+        self.deleted.discard(g.key)
+
+    def forget(self, k: Key):
+        self.dirty.pop(k, None)
+        self.deleted.add(k)
+
+    def spill(self, g: Game):
+        # evicted from memory, write it on the next flush and let load() bring it back later
+        self.touch(g)
+        self.misses.pop(g.key, None)
+
+    def pin(self, chat_id: int):
+        self.pinned_dirty.add(chat_id)
+
+    def is_pinned(self, chat_id: int) -> bool:
+        return chat_id in self.pinned_dirty or self.backend.is_pinned(chat_id)
+
+    def load(self, k: Key) -> Optional[Game]:
+        # an evicted game waiting for its write is the live copy, the backend still has an older one or none
+        g = self.dirty.get(k)
+        if g is not None:
+            return g
+        if k in self.deleted:
+            return None
+        g = self.writing.get(k)
+        if g is not None:
+            return g
+        if k in self.misses:
+            self.misses.move_to_end(k)
+            return None
+        blob = self.backend.load(k)
+        if blob:
+            return loads(blob)
+        self.misses[k] = None
+        if len(self.misses) > self.max_misses:
+            self.misses.popitem(last=False)
+        return None
+
+    def key_for_user(self, uid: int) -> Optional[Key]:
+        return self.backend.key_for_user(uid)
+
+    async def flush(self):
+        async with self._lock:
+            if not (self.dirty or self.deleted or self.pinned_dirty):
+                return
+            dirty, self.dirty = self.dirty, {}
+            deleted, self.deleted = self.deleted, set()
+            pinned, self.pinned_dirty = self.pinned_dirty, set()
+            # serialize on the loop so no handler mutates a game mid-dump, write in a thread
+            batch = {k: (dumps(g), list(g.players), g.deadline) for k, g in dirty.items()}
+            self.writing = dirty
+            try:
+                await asyncio.to_thread(self._write, batch, deleted, pinned)
+            except Exception:
+                log.exception("store flush failed, %d games kept dirty", len(batch))
+                for k, g in dirty.items():
+                    self.dirty.setdefault(k, g)
+                self.deleted |= deleted
+                self.pinned_dirty |= pinned
+            finally:
+                self.writing = {}
+
+    def _write(self, batch, deleted, pinned):
+        if deleted: self.backend.delete_many(deleted)
+        if batch: self.backend.save_many(batch)
+        if pinned: self.backend.save_pinned(pinned)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        self.backend.close()